@@ -0,0 +1,392 @@
+import hashlib
+import json
+import os
+import traceback
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from copy import deepcopy
+from dataclasses import fields, is_dataclass
+from glob import glob
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+import yaml
+from PIL import Image
+
+from .assets import TRANSFORM_VIEW_ASSETS
+from .core.cache import DiskCache
+from .core.tiling import TiledExecutor
+from .core.stats import FiberStatistics
+from .core.transform_handler import DEFAULT_DISK_CACHE_BYTES, TransformHandler
+from .core.transforms import DEFAULT_PRECISION, ExecutionContext
+from .core.utils import available_cpus, read_grayscale_image
+from .core.vtransforms import transform_views_from_config
+
+
+IMAGE_SUFFIXES = {'.bmp', '.jpg', '.jpeg', '.npy', '.png', '.raw', '.tif', '.tiff'}
+MANIFEST_NAME = 'results.jsonl'
+STATISTICS_NAME = 'statistics.json'
+# Rough peak memory of one pipeline run per source pixel in values of the transforms' float dtype,
+# cached outputs and deconvolution intermediates included
+FLOATS_PER_PIXEL_ESTIMATE = 8
+BYTES_PER_PIXEL_ESTIMATE = FLOATS_PER_PIXEL_ESTIMATE * np.dtype(DEFAULT_PRECISION.float_dtype).itemsize
+
+
+def load_params(path=None):
+    """
+    Frozen parameter set in the `transform_views.yaml` format, applied over the built-in chain.
+
+    A slider may be given as a plain value, it then overrides `current_value` of the built-in config.
+    Transforms missing from the built-in chain are appended to it.
+    """
+    config = deepcopy(TRANSFORM_VIEW_ASSETS)
+    if path is None:
+        return config
+
+    with open(path, 'r', encoding='utf-8') as file:
+        user_config = yaml.safe_load(file)
+
+    for transform_name, transform_config in user_config.items():
+        config.setdefault(transform_name, {})
+
+        for name, value in (transform_config or {}).items():
+            if isinstance(value, dict) or not isinstance(config[transform_name].get(name), dict):
+                config[transform_name][name] = value
+            else:
+                config[transform_name][name]['current_value'] = value
+
+    return config
+
+
+def collect_images(inputs):
+    paths = []
+
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = sorted(Path(item).rglob('*'))
+        else:
+            candidates = sorted(Path(path) for path in glob(item, recursive=True))
+
+        paths.extend(path for path in candidates if path.is_file() and path.suffix.lower() in IMAGE_SUFFIXES)
+
+    return list(dict.fromkeys(path.absolute() for path in paths))
+
+
+def estimate_memory(path, tile_size=None, raw_shape=None):
+    suffix = Path(path).suffix.lower()
+
+    if suffix == '.raw':
+        height, width = raw_shape
+    elif suffix == '.npy':
+        height, width = np.load(path, mmap_mode='r').shape[:2]
+    else:
+        with Image.open(path) as image:
+            width, height = image.size
+
+    if tile_size is not None:
+        width, height = min(width, tile_size), min(height, tile_size)
+
+    return width * height * BYTES_PER_PIXEL_ESTIMATE
+
+
+def result_path(output_dir, image_path):
+    digest = hashlib.sha1(str(image_path).encode('utf-8')).hexdigest()[:8]
+
+    return Path(output_dir) / f'{Path(image_path).stem}-{digest}.npz'
+
+
+def settings_digest(config, **settings):
+    """Digest of the parameters and settings that change the results of an image."""
+    text = json.dumps({'config': config, **settings}, sort_keys=True, default=str)
+
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def _node_arrays(node, output_names):
+    arrays = {}
+
+    for name in output_names:
+        value = node[name]
+
+        if is_dataclass(value):
+            for field in fields(value):
+                arrays[f'{name}.{field.name}'] = np.asarray(getattr(value, field.name))
+        elif isinstance(value, np.ndarray):
+            arrays[name] = value
+
+    return arrays
+
+
+def process_image(
+    image_path,
+    output_dir,
+    config,
+    output_names=None,
+    tile_size=None,
+    threads=None,
+    cache_dir=None,
+    cache_bytes=DEFAULT_DISK_CACHE_BYTES,
+    pixel_spacing=1.0,
+    raw_shape=None,
+    raw_dtype=None,
+    diameter_bin_width=None,
+):
+    record = {'image': str(image_path), 'status': 'ok', 'pixel_spacing': pixel_spacing, 'timings': {}}
+    execution = ExecutionContext(threads)
+    executor = None
+
+    try:
+        start = perf_counter()
+        source_image = read_grayscale_image(
+            image_path, mmap=tile_size is not None, scratch_dir=output_dir, raw_shape=raw_shape, raw_dtype=raw_dtype
+        )
+        record['timings']['read'] = perf_counter() - start
+
+        transforms = transform_views_from_config(config)
+
+        if tile_size is None:
+            disk_cache = None if cache_dir is None else DiskCache(cache_dir, cache_bytes)
+            handler = TransformHandler(
+                source_image,
+                transforms=transforms,
+                execution=execution,
+                pixel_spacing=pixel_spacing,
+                disk_cache=disk_cache,
+            )
+
+            for idx, transform in enumerate(transforms):
+                start = perf_counter()
+                node = handler.get_result_node(idx)
+                record['timings'][transform.transform_name] = perf_counter() - start
+        else:
+            for transform in transforms:
+                transform.set_execution(execution)
+                transform.set_pixel_spacing(pixel_spacing)
+
+            executor = TiledExecutor(tile_size, scratch_dir=output_dir)
+            node = executor(transforms, source_image)
+            record['timings'].update(executor.timings)
+
+        output_path = result_path(output_dir, image_path)
+        tmp_path = output_path.with_suffix('.tmp.npz')
+        np.savez_compressed(tmp_path, **_node_arrays(node, output_names or transforms[-1].output_names))
+        os.replace(tmp_path, output_path)
+
+        # Resolved, so that a resumed run started from another directory finds the output
+        record['output'] = str(output_path.resolve())
+
+        if 'fiber_segments' in node:
+            outputs = [node[name] for name in ('fiber_segments', 'fitting_results') if name in node]
+            statistics = FiberStatistics.for_pixel_spacing(pixel_spacing, diameter_bin_width)
+            record['statistics'] = statistics.update(*outputs).to_dict()
+    except Exception as e:
+        record['status'] = 'error'
+        record['error'] = f'{type(e).__name__}: {e}'
+        record['traceback'] = traceback.format_exc()
+    finally:
+        if executor is not None:
+            executor.cleanup()
+
+    record['timings']['total'] = sum(record['timings'].values())
+
+    return record
+
+
+def completed_images(output_dir, digest=None):
+    """
+    Images whose last successful record has an existing output and, if given, `digest`. The output of an image
+    is overwritten by every run, so earlier records with the same digest do not count.
+    """
+    manifest = Path(output_dir) / MANIFEST_NAME
+    latest = {}
+
+    if manifest.exists():
+        with open(manifest, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Line cut by an interruption
+                    continue
+
+                if record['status'] == 'ok':
+                    latest[record['image']] = record
+
+    return {
+        image
+        for image, record in latest.items()
+        if (digest is None or record.get('digest') == digest) and Path(record['output']).exists()
+    }
+
+
+def pooled_statistics(output_dir, digest=None):
+    """Statistics of the last successful record of every image in the manifest, of `digest` if given, merged."""
+    manifest = Path(output_dir) / MANIFEST_NAME
+    latest = {}
+
+    if manifest.exists():
+        with open(manifest, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+                if digest is not None and record.get('digest') != digest:
+                    continue
+
+                if record['status'] == 'ok' and 'statistics' in record:
+                    latest[record['image']] = record['statistics']
+
+    # Pooled into the bins of the records, every record of a digest has the same bins
+    pooled = None
+    for statistics in latest.values():
+        statistics = FiberStatistics.from_dict(statistics)
+        pooled = statistics if pooled is None else pooled.merge(statistics)
+
+    return FiberStatistics() if pooled is None else pooled
+
+
+def run_batch(
+    inputs,
+    output_dir,
+    config=None,
+    workers=None,
+    memory_limit=None,
+    output_names=None,
+    tile_size=None,
+    threads=None,
+    cache_dir=None,
+    cache_bytes=DEFAULT_DISK_CACHE_BYTES,
+    pixel_spacing=1.0,
+    raw_shape=None,
+    raw_dtype=None,
+    diameter_bin_width=None,
+):
+    """
+    Run the transform chain over images with a process pool, appending one record per image to `results.jsonl`.
+
+    Images already recorded as processed with the same parameters, pixel spacing and outputs are skipped,
+    so an interrupted run resumes where it stopped and a run with changed parameters processes every image again.
+    With `memory_limit` (bytes) images are admitted only while their estimated memory fits into it,
+    one image is always admitted so that a single huge image still runs.
+    With `tile_size` every image runs through `TiledExecutor`, its memory is estimated by the tile size.
+    Every worker runs transforms on `threads` threads, by default the available CPUs are split between workers.
+    Fiber statistics of all images processed with these settings, including those of earlier runs, are pooled
+    into `statistics.json`.
+    With `cache_dir` outputs of every step are kept in a `DiskCache` of `cache_bytes` shared by the workers,
+    a rerun with changed parameters resumes every image from the deepest step whose parameters did not change.
+    Tiled runs do not use the cache. Measurements are reported in units of `pixel_spacing`, diameters are
+    binned by `diameter_bin_width` in the same units, see `FiberStatistics.for_pixel_spacing`.
+    Headerless `.raw` images are read as `raw_shape`, (height, width), arrays of `raw_dtype`.
+    When a worker process dies the pool is replaced and the images in flight are retried one at a time,
+    so that only the image that takes a worker down is recorded as failed.
+    """
+    config = load_params() if config is None else config
+    workers = workers or available_cpus()
+    threads = threads or max(1, available_cpus() // workers)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    digest = settings_digest(
+        config,
+        pixel_spacing=pixel_spacing,
+        output_names=output_names,
+        raw_shape=raw_shape,
+        raw_dtype=raw_dtype,
+        diameter_bin_width=diameter_bin_width,
+    )
+    completed = completed_images(output_dir, digest)
+    queue = deque(path for path in collect_images(inputs) if str(path) not in completed)
+    records = []
+
+    # Images that were in flight when a worker process died, each of them is retried alone
+    suspects = set()
+    executor = ProcessPoolExecutor(workers)
+
+    try:
+        with open(output_dir / MANIFEST_NAME, 'a', encoding='utf-8') as manifest:
+
+            def write_record(record):
+                record['digest'] = digest
+                manifest.write(json.dumps(record) + '\n')
+                manifest.flush()
+                records.append(record)
+
+            running, in_flight = {}, 0
+
+            while queue or running:
+                while queue and len(running) < workers:
+                    if running and (queue[0] in suspects or any(path in suspects for path, _ in running.values())):
+                        break
+
+                    try:
+                        memory = estimate_memory(queue[0], tile_size, raw_shape)
+                    except Exception:
+                        memory = 0
+
+                    if running and memory_limit is not None and in_flight + memory > memory_limit:
+                        break
+
+                    image_path = queue.popleft()
+                    future = executor.submit(
+                        process_image,
+                        image_path,
+                        output_dir,
+                        config,
+                        output_names,
+                        tile_size,
+                        threads,
+                        cache_dir,
+                        cache_bytes,
+                        pixel_spacing,
+                        raw_shape,
+                        raw_dtype,
+                        diameter_bin_width,
+                    )
+                    running[future] = (image_path, memory)
+                    in_flight += memory
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                    # A worker process died, e.g. killed by the OOM killer, and every other future of the pool fails
+                    done, _ = wait(running)
+
+                broken = []
+                for future in done:
+                    image_path, memory = running.pop(future)
+                    in_flight -= memory
+
+                    try:
+                        record = future.result()
+                    except BrokenProcessPool as e:
+                        broken.append((image_path, e))
+                        continue
+                    except Exception as e:
+                        record = {'image': str(image_path), 'status': 'error', 'error': f'{type(e).__name__}: {e}'}
+
+                    write_record(record)
+
+                if not broken:
+                    continue
+
+                executor.shutdown()
+                executor = ProcessPoolExecutor(workers)
+
+                if len(broken) == 1:
+                    # The only image in flight is the one that took the worker down
+                    image_path, e = broken[0]
+                    write_record({'image': str(image_path), 'status': 'error', 'error': f'{type(e).__name__}: {e}'})
+                else:
+                    suspects.update(image_path for image_path, _ in broken)
+                    queue.extendleft(reversed([image_path for image_path, _ in broken]))
+    finally:
+        executor.shutdown()
+
+    statistics = pooled_statistics(output_dir, digest)
+    with open(output_dir / STATISTICS_NAME, 'w', encoding='utf-8') as file:
+        json.dump({'summary': statistics.summary(), 'statistics': statistics.to_dict()}, file, indent=2)
+
+    return records
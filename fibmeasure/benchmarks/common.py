@@ -0,0 +1,92 @@
+from time import perf_counter
+
+import numpy as np
+
+from ..core.transform_handler import TransformHandler
+
+
+# Synthetic fibers of this thickness in pixels pass every step of the chain with `CHAIN_PARAMS`
+FIBER_THICKNESS = 9
+# Parameters over the defaults of the chain for synthetic images: the default opening removes fibers this thin,
+# the default distance threshold leaves a sparse skeleton and the default linearity threshold fits almost no lines
+CHAIN_PARAMS = {
+    'Opening': {'radius': 2},
+    'SkeletonizeEDT': {'threshold_abs': 3},
+    'LineFittingTLS': {'block': 32, 'linearity_thr': 100},
+}
+
+
+def best_time(func, *args, repeat=3, **kwargs):
+    best, result = float('inf'), None
+
+    for _ in range(repeat):
+        start = perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, perf_counter() - start)
+
+    return best, result
+
+
+def random_lines_mask(shape, num_lines, length=(20, 200), seed=0):
+    """Boolean mask with `num_lines` one pixel wide random segments, a stand-in for a fiber skeleton."""
+    rng = np.random.default_rng(seed)
+    H, W = shape
+
+    starts = rng.uniform((0, 0), (H, W), size=(num_lines, 2))
+    angles = rng.uniform(0, np.pi, size=num_lines)
+    lengths = rng.uniform(*length, size=num_lines)
+
+    t = np.linspace(0, 1, int(np.ceil(length[1])) * 2)
+    ys = starts[:, :1] + np.sin(angles)[:, None] * lengths[:, None] * t[None]
+    xs = starts[:, 1:] + np.cos(angles)[:, None] * lengths[:, None] * t[None]
+    ys, xs = np.round(ys).astype(int).ravel(), np.round(xs).astype(int).ravel()
+    inside = (ys >= 0) & (ys < H) & (xs >= 0) & (xs < W)
+
+    mask = np.zeros(shape, dtype=bool)
+    mask[ys[inside], xs[inside]] = True
+
+    return mask
+
+
+def fibers_for_density(shape, fibers_per_mpx):
+    """Number of fibers giving `fibers_per_mpx` fibers per 2**20 pixels, at least one."""
+    return max(1, int(fibers_per_mpx * shape[0] * shape[1] / 2**20))
+
+
+def synthetic_fiber_image(shape, num_fibers, thickness=3, blur=1.0, noise=0.05, seed=0):
+    """Grayscale float32 image in [0, 1] with bright straight fibers on a dark noisy background."""
+    from scipy.ndimage import distance_transform_edt, gaussian_filter
+
+    rng = np.random.default_rng(seed)
+    axes = random_lines_mask(shape, num_fibers, length=(min(shape) / 4, min(shape)), seed=seed)
+    fibers = distance_transform_edt(~axes) <= thickness / 2
+
+    image = gaussian_filter(fibers.astype(np.float32), blur) + rng.normal(0, noise, size=shape).astype(np.float32)
+
+    return np.clip(image, 0, 1).astype(np.float32)
+
+
+def chain_handler(image, params=CHAIN_PARAMS, **kwargs):
+    """`TransformHandler` of `image` with `params`, `{transform name: {parameter: value}}`, set on its chain."""
+    handler = TransformHandler(image, **kwargs)
+
+    for transform in handler.transforms:
+        for name, value in params.get(transform.transform_name, {}).items():
+            transform.set_current_value(name, value)
+
+    return handler
+
+
+def check_nonempty(nodes):
+    """
+    Raises `ValueError` when a mask of the result nodes of a chain is empty or no line is fitted, timings
+    of a chain that has nothing to work on are meaningless.
+    """
+    for node in nodes:
+        for name, value in node.items():
+            if isinstance(value, np.ndarray) and value.dtype == bool and not value.any():
+                raise ValueError(f'Mask {name} is empty, the input image or parameters leave no fibers')
+
+        fitting = node.get('fitting_results')
+        if fitting is not None and not np.count_nonzero(fitting.fitting_blocked_params[..., 3]):
+            raise ValueError('No lines are fitted, the input image or parameters leave no fibers')
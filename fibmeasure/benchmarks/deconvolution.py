@@ -0,0 +1,42 @@
+import numpy as np
+
+from ..core.transforms import RichardsonLucyEngine
+from .common import best_time, synthetic_fiber_image
+
+
+def benchmark_box_psf(sizes=(1024, 2048), psf_sizes=range(2, 10), num_iter=4, workers=None):
+    """Running-sum path for the uniform PSF of `RichardsonLucyDeconv` against the generic direct/FFT path."""
+    rows = []
+
+    for size in sizes:
+        image = synthetic_fiber_image((size, size), max(1, size // 8))
+
+        for psf_size in psf_sizes:
+            psf = np.full((psf_size, psf_size), 1 / psf_size**2, dtype=np.float32)
+            # Fresh engines, so that neither run warm-starts from the previous one
+            generic_time, expected = best_time(
+                lambda: RichardsonLucyEngine(workers, separable=False)(image, psf, num_iter)
+            )
+            box_time, result = best_time(lambda: RichardsonLucyEngine(workers)(image, psf, num_iter))
+
+            rows.append(
+                dict(
+                    size=size,
+                    psf_size=psf_size,
+                    generic_s=generic_time,
+                    box_s=box_time,
+                    speedup=generic_time / box_time,
+                    max_abs_diff=float(np.abs(result - expected).max()),
+                )
+            )
+
+    return rows
+
+
+if __name__ == '__main__':
+    print(f"{'size':>6} {'psf':>4} {'generic, s':>11} {'box, s':>8} {'speedup':>8} {'max diff':>10}")
+    for row in benchmark_box_psf():
+        print(
+            f"{row['size']:>6} {row['psf_size']:>4} {row['generic_s']:>11.4f} {row['box_s']:>8.4f} "
+            f"{row['speedup']:>8.1f} {row['max_abs_diff']:>10.2e}"
+        )
@@ -0,0 +1,171 @@
+import numpy as np
+
+from ..core.ops import (
+    Fitting,
+    MomentIndex,
+    blocked_line_fitting_tls,
+    line_params_tls,
+    visualize_fitting,
+)
+from .common import best_time, fibers_for_density, random_lines_mask
+
+
+def blocked_line_fitting_tls_loop(
+    skeleton, linearity_thr=100.0, block=16, filtration_image=None, filtration_thr=0.8, dist_thr=2
+):
+    """Reference for `blocked_line_fitting_tls`: every block is fitted by `line_params_tls` in a Python loop."""
+    H, W = skeleton.shape
+
+    half_block = block // 2
+
+    H_block = (H + half_block - 1) // half_block
+    W_block = (W + half_block - 1) // half_block
+    fitting_blocked_params = np.zeros((H_block, W_block, 4), dtype=np.float32)
+
+    for i in range(H_block):
+        for j in range(W_block):
+            crop = skeleton[i * half_block : (i + 2) * half_block, j * half_block : (j + 2) * half_block]
+
+            if crop.sum() >= 4:
+                y, x = np.where(crop)
+
+                A, B, C, linearity = line_params_tls(x, y)
+
+                if linearity >= linearity_thr:
+                    if filtration_image is None:
+                        fitting_blocked_params[i, j] = np.asarray([A, B, C, 1])
+                    else:
+                        x_c, y_c = np.arange(block), np.arange(block)
+                        block_lin_interp = np.abs(A * x_c[None, :] + B * y_c[:, None] + C) < dist_thr
+
+                        filtration_crop = filtration_image[
+                            i * half_block : (i + 2) * half_block, j * half_block : (j + 2) * half_block
+                        ]
+                        assign_size = filtration_crop.shape
+                        block_lin_interp = block_lin_interp[: assign_size[0], : assign_size[1]]
+
+                        if block_lin_interp.sum() * filtration_thr <= (filtration_crop & block_lin_interp).sum():
+                            fitting_blocked_params[i, j] = np.asarray([A, B, C, 1])
+
+    return Fitting(skeleton.shape, block, fitting_blocked_params)
+
+
+def visualize_fitting_loop(fitting, dist_thr=2):
+    """Reference for `visualize_fitting`: the line of every valid block is drawn over its tile in a Python loop."""
+    block = fitting.block_size
+    half_block = block // 2
+    fitting_blocked_params = fitting.fitting_blocked_params
+    H_block, W_block = fitting.fitting_blocked_params.shape[:-1]
+
+    result = np.zeros(fitting.origin_shape, dtype=bool)
+    for i in range(H_block):
+        for j in range(W_block):
+            A, B, C, valid = fitting_blocked_params[i, j]
+
+            if valid:
+                x_c, y_c = np.arange(block), np.arange(block)
+                block_lin_interp = np.abs(A * x_c[None, :] + B * y_c[:, None] + C) < dist_thr
+
+                assign_size = result[i * half_block : (i + 2) * half_block, j * half_block : (j + 2) * half_block].shape
+
+                block_lin_interp = block_lin_interp[: assign_size[0], : assign_size[1]]
+
+                result[i * half_block : (i + 2) * half_block, j * half_block : (j + 2) * half_block] = block_lin_interp
+
+    return result
+
+
+def _line_params_diff(params, expected):
+    # (A, B, C) and (-A, -B, -C) describe the same line, the eigen solver does not fix the sign
+    valid_diff = np.abs(params[..., 3] - expected[..., 3])
+    lines_diff = np.minimum(
+        np.abs(params[..., :3] - expected[..., :3]), np.abs(params[..., :3] + expected[..., :3])
+    ).max(axis=-1)
+
+    return float(np.maximum(valid_diff, lines_diff).max())
+
+
+def benchmark_line_fitting(sizes=(512, 1024, 2048, 4096), blocks=(16, 32, 64, 128), lines_per_mpx=200, repeat=3):
+    rows = []
+
+    for size in sizes:
+        skeleton = random_lines_mask((size, size), fibers_for_density((size, size), lines_per_mpx))
+        filtration_image = skeleton | np.roll(skeleton, 1, axis=0) | np.roll(skeleton, 1, axis=1)
+        index_time, moment_index = best_time(MomentIndex, skeleton, repeat=repeat)
+
+        for block in blocks:
+            kwargs = dict(linearity_thr=50, block=block, filtration_image=filtration_image, filtration_thr=0.5)
+
+            loop_time, expected = best_time(blocked_line_fitting_tls_loop, skeleton, repeat=repeat, **kwargs)
+            vectorized_time, fitting = best_time(blocked_line_fitting_tls, skeleton, repeat=repeat, **kwargs)
+            indexed_time, _ = best_time(
+                blocked_line_fitting_tls, skeleton, repeat=repeat, moment_index=moment_index, **kwargs
+            )
+
+            rows.append(
+                dict(
+                    size=size,
+                    block=block,
+                    loop_s=loop_time,
+                    vectorized_s=vectorized_time,
+                    speedup=loop_time / vectorized_time,
+                    index_build_s=index_time,
+                    indexed_s=indexed_time,
+                    max_abs_diff=_line_params_diff(fitting.fitting_blocked_params, expected.fitting_blocked_params),
+                )
+            )
+
+    return rows
+
+
+def benchmark_visualize_fitting(sizes=(512, 1024, 2048, 4096), blocks=(16, 32, 64, 128), lines_per_mpx=200, repeat=3):
+    rows = []
+
+    for size in sizes:
+        skeleton = random_lines_mask((size, size), fibers_for_density((size, size), lines_per_mpx))
+        viewport = (slice(size // 4, size // 4 + 256), slice(size // 4, size // 4 + 256))
+
+        for block in blocks:
+            fitting = blocked_line_fitting_tls(skeleton, linearity_thr=50, block=block)
+
+            loop_time, expected = best_time(visualize_fitting_loop, fitting, repeat=repeat)
+            vectorized_time, result = best_time(visualize_fitting, fitting, repeat=repeat)
+            viewport_time, _ = best_time(visualize_fitting, fitting, roi=viewport, repeat=repeat)
+
+            rows.append(
+                dict(
+                    size=size,
+                    block=block,
+                    loop_s=loop_time,
+                    vectorized_s=vectorized_time,
+                    speedup=loop_time / vectorized_time,
+                    viewport_256_s=viewport_time,
+                    equal=bool(np.array_equal(result, expected)),
+                )
+            )
+
+    return rows
+
+
+if __name__ == '__main__':
+    print(
+        f"{'size':>6} {'block':>6} {'loop, s':>10} {'vectorized, s':>14} {'speedup':>8} "
+        f"{'index, s':>9} {'indexed, s':>11} {'max diff':>10}"
+    )
+    for row in benchmark_line_fitting():
+        print(
+            f"{row['size']:>6} {row['block']:>6} {row['loop_s']:>10.4f} {row['vectorized_s']:>14.4f} "
+            f"{row['speedup']:>8.1f} {row['index_build_s']:>9.4f} {row['indexed_s']:>11.4f} "
+            f"{row['max_abs_diff']:>10.2e}"
+        )
+
+    print()
+    print(
+        f"{'size':>6} {'block':>6} {'loop, s':>10} {'vectorized, s':>14} {'speedup':>8} "
+        f"{'256px roi, s':>13} {'equal':>6}"
+    )
+    for row in benchmark_visualize_fitting():
+        print(
+            f"{row['size']:>6} {row['block']:>6} {row['loop_s']:>10.4f} {row['vectorized_s']:>14.4f} "
+            f"{row['speedup']:>8.1f} {row['viewport_256_s']:>13.4f} {str(row['equal']):>6}"
+        )
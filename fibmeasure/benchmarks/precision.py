@@ -0,0 +1,63 @@
+import numpy as np
+
+from ..core.transforms import DEFAULT_PRECISION, FLOAT64_PRECISION
+from .common import (
+    CHAIN_PARAMS,
+    FIBER_THICKNESS,
+    chain_handler,
+    check_nonempty,
+    fibers_for_density,
+    synthetic_fiber_image,
+)
+
+
+# Accepted deviation from the float64 baseline: absolute for float outputs, fraction of pixels for masks
+FLOAT_ATOL = 1e-4
+MASK_MISMATCH_FRACTION = 1e-3
+
+
+def _run_chain(image, precision, params=CHAIN_PARAMS):
+    handler = chain_handler(image, params, precision=precision)
+    nodes = [handler.get_result_node(idx) for idx in range(len(handler.transforms))]
+    check_nonempty(nodes)
+
+    return handler, nodes
+
+
+def compare_precision(sizes=(512, 1024, 2048), fibers_per_mpx=300, precision=DEFAULT_PRECISION, params=CHAIN_PARAMS):
+    """
+    Memory held by the handler after the full chain with `params` and its deviation from the float64 baseline.
+
+    Float outputs are compared by the maximum absolute difference, masks by the fraction of differing pixels.
+    Raises `ValueError` when the synthetic image leaves a step of the chain without fibers.
+    """
+    rows = []
+
+    for size in sizes:
+        shape = (size, size)
+        image = synthetic_fiber_image(shape, fibers_for_density(shape, fibers_per_mpx), FIBER_THICKNESS)
+        baseline_handler, baseline_nodes = _run_chain(image, FLOAT64_PRECISION, params)
+        handler, nodes = _run_chain(image, precision, params)
+
+        row = dict(size=size, baseline_cache_bytes=baseline_handler.nbytes, cache_bytes=handler.nbytes)
+        row['memory_ratio'] = row['cache_bytes'] / row['baseline_cache_bytes']
+
+        row['within_bounds'] = True
+        for transform, node, baseline_node in zip(handler.transforms, nodes, baseline_nodes):
+            value, expected = node[transform.visualization_key], baseline_node[transform.visualization_key]
+
+            if value.dtype == bool:
+                row[transform.transform_name] = float(np.mean(value != expected))
+                row['within_bounds'] &= row[transform.transform_name] <= MASK_MISMATCH_FRACTION
+            else:
+                row[transform.transform_name] = float(np.abs(value.astype(np.float64) - expected).max())
+                row['within_bounds'] &= row[transform.transform_name] <= FLOAT_ATOL
+
+        rows.append(row)
+
+    return rows
+
+
+if __name__ == '__main__':
+    for row in compare_precision():
+        print(row)
@@ -0,0 +1,264 @@
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+
+from ..__version__ import __version__
+from ..core.morphology import disk_opening
+from ..core.ops import (
+    MomentIndex,
+    blocked_line_fitting_tls,
+    component_table,
+    measure_fibers,
+    select_components,
+    visualize_fitting,
+)
+from ..core.transforms import ExecutionContext
+from ..core.utils import available_cpus
+from .common import (
+    CHAIN_PARAMS,
+    FIBER_THICKNESS,
+    chain_handler,
+    check_nonempty,
+    fibers_for_density,
+    synthetic_fiber_image,
+)
+from .threads import default_thread_counts
+
+
+# A case is reported as a regression when it is this much slower than the baseline
+DEFAULT_TOLERANCE = 0.1
+
+
+def _copy_node(node):
+    # Fresh arrays, so that a transform does not warm-start from the previous call
+    return {name: np.array(value) if isinstance(value, np.ndarray) else value for name, value in node.items()}
+
+
+def _measure(func, repeat):
+    """Best time of `func` over `repeat` calls, then its peak of traced allocations in one more call."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        best = min(best, perf_counter() - start)
+
+    # numpy reports its buffers to tracemalloc, memory allocated by compiled extensions directly is not seen
+    tracemalloc.start()
+    try:
+        func()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return best, peak_bytes
+
+
+def _ops_cases(node, threads):
+    """Calls of `core.ops` and `core.morphology` functions on the outputs of the default chain."""
+    fitting = node['fitting_results']
+    components = node['components']
+
+    return {
+        'component_table': lambda: component_table(node['bin_image']),
+        'select_components': lambda: select_components(components, components.sizes >= np.median(components.sizes)),
+        'MomentIndex': lambda: MomentIndex(node['skeleton'], compact=True),
+        'blocked_line_fitting_tls': lambda: blocked_line_fitting_tls(
+            node['skeleton'],
+            block=fitting.block_size,
+            filtration_image=node['bin_image'],
+            moment_index=node['skeleton_index'],
+        ),
+        'visualize_fitting': lambda: visualize_fitting(fitting),
+        'measure_fibers': lambda: measure_fibers(fitting, node['distance']),
+        'disk_opening': lambda: disk_opening(node['bin_image'], 5, num_threads=threads),
+    }
+
+
+def benchmark_suite(
+    sizes=(512, 1024, 2048),
+    thread_counts=None,
+    fibers_per_mpx=300,
+    thickness=FIBER_THICKNESS,
+    noise=0.05,
+    repeat=3,
+    params=CHAIN_PARAMS,
+):
+    """
+    Time and peak traced memory of every transform of the chain with `params` (see `common.chain_handler`),
+    of `core.ops` functions and of full `TransformHandler` runs, for every image size and number of threads.
+    One row per case. Raises `ValueError` when the synthetic image leaves a step of the chain without fibers.
+    """
+    thread_counts = thread_counts or default_thread_counts()
+    rows = []
+
+    for size in sizes:
+        shape = (size, size)
+        image = synthetic_fiber_image(shape, fibers_for_density(shape, fibers_per_mpx), thickness, noise=noise)
+
+        handler = chain_handler(image, params)
+        input_nodes = [handler.get_result_node(idx - 1) for idx in range(len(handler.transforms))]
+        final_node = handler.get_result_node(len(handler.transforms) - 1)
+        check_nonempty(input_nodes + [final_node])
+
+        for threads in thread_counts:
+            execution = ExecutionContext(threads)
+            cases = []
+
+            for transform, input_node in zip(handler.transforms, input_nodes):
+                transform.set_execution(execution)
+                cases.append(
+                    ('transform', transform.transform_name, lambda t=transform, node=input_node: t(_copy_node(node)))
+                )
+
+            cases.extend(('ops', name, func) for name, func in _ops_cases(final_node, threads).items())
+            cases.append(
+                (
+                    'pipeline',
+                    'TransformHandler',
+                    lambda: chain_handler(image, params, execution=execution).get_result_node(
+                        len(handler.transforms) - 1
+                    ),
+                )
+            )
+
+            for kind, name, func in cases:
+                seconds, peak_bytes = _measure(func, repeat)
+                rows.append(
+                    dict(kind=kind, name=name, size=size, threads=threads, seconds=seconds, peak_bytes=peak_bytes)
+                )
+
+    return rows
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).parent, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    return dict(
+        version=__version__,
+        commit=_git_commit(),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        platform=platform.platform(),
+        cpus=available_cpus(),
+        date=datetime.now(timezone.utc).isoformat(),
+    )
+
+
+def run_suite(output=None, **kwargs):
+    """Runs `benchmark_suite` and writes the results with the environment to the JSON file `output`."""
+    results = dict(environment=environment(), parameters=kwargs, rows=benchmark_suite(**kwargs))
+
+    if output is not None:
+        with open(output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+
+    return results
+
+
+def _case_key(row):
+    return row['kind'], row['name'], row['size'], row['threads']
+
+
+def compare_results(baseline, current, tolerance=DEFAULT_TOLERANCE):
+    """Cases of both result sets with their time and memory ratios, `regression` when time grew over `tolerance`."""
+    baseline_rows = {_case_key(row): row for row in baseline['rows']}
+    rows = []
+
+    for row in current['rows']:
+        base = baseline_rows.get(_case_key(row))
+        if base is None:
+            continue
+
+        time_ratio = row['seconds'] / base['seconds']
+        rows.append(
+            dict(
+                kind=row['kind'],
+                name=row['name'],
+                size=row['size'],
+                threads=row['threads'],
+                baseline_s=base['seconds'],
+                seconds=row['seconds'],
+                time_ratio=time_ratio,
+                memory_ratio=row['peak_bytes'] / base['peak_bytes'] if base['peak_bytes'] else float('nan'),
+                regression=time_ratio > 1 + tolerance,
+            )
+        )
+
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m fibmeasure.benchmarks.suite')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run = subparsers.add_parser('run', help='Run the suite and write the results to a JSON file')
+    run.add_argument('-o', '--output', required=True)
+    run.add_argument('--sizes', nargs='+', type=int, default=[512, 1024, 2048])
+    run.add_argument('--threads', nargs='+', type=int, help='Thread counts, defaults to powers of two up to the CPUs')
+    run.add_argument('--fibers-per-mpx', type=float, default=300)
+    run.add_argument('--thickness', type=float, default=FIBER_THICKNESS)
+    run.add_argument('--noise', type=float, default=0.05)
+    run.add_argument('--repeat', type=int, default=3)
+
+    compare = subparsers.add_parser('compare', help='Compare two result files, fails on regressions')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        results = run_suite(
+            args.output,
+            sizes=tuple(args.sizes),
+            thread_counts=args.threads,
+            fibers_per_mpx=args.fibers_per_mpx,
+            thickness=args.thickness,
+            noise=args.noise,
+            repeat=args.repeat,
+        )
+
+        print(f"{'kind':>9} {'name':>24} {'size':>6} {'threads':>8} {'time, s':>9} {'peak, MiB':>10}")
+        for row in results['rows']:
+            print(
+                f"{row['kind']:>9} {row['name']:>24} {row['size']:>6} {row['threads']:>8} "
+                f"{row['seconds']:>9.4f} {row['peak_bytes'] / 2**20:>10.1f}"
+            )
+
+        return 0
+
+    with open(args.baseline, 'r', encoding='utf-8') as file:
+        baseline = json.load(file)
+    with open(args.current, 'r', encoding='utf-8') as file:
+        current = json.load(file)
+
+    rows = compare_results(baseline, current, args.tolerance)
+
+    print(f"{'kind':>9} {'name':>24} {'size':>6} {'threads':>8} {'time ratio':>11} {'memory ratio':>13}")
+    for row in rows:
+        flag = '  regression' if row['regression'] else ''
+        print(
+            f"{row['kind']:>9} {row['name']:>24} {row['size']:>6} {row['threads']:>8} "
+            f"{row['time_ratio']:>11.2f} {row['memory_ratio']:>13.2f}{flag}"
+        )
+
+    return 1 if any(row['regression'] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
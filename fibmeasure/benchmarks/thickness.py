@@ -0,0 +1,54 @@
+import numpy as np
+from imops.morphology import distance_transform_edt
+
+from ..core.ops import Fitting, measure_fibers
+from .common import best_time
+
+
+def parallel_fibers(num_fibers, block=16, width=5):
+    """
+    Horizontal fibers of `width` pixels, one per block, and the fitting with one line along every fiber.
+
+    Blocks are placed with a step of `block // 2`, every line crosses the cell of its block that the block draws.
+    """
+    half_block = block // 2
+    grid = int(np.ceil(np.sqrt(num_fibers)))
+    size = grid * half_block
+
+    rows = np.arange(size) % half_block
+    axis = half_block // 2
+    mask = np.repeat((np.abs(rows - axis) <= width // 2)[:, None], size, axis=1)
+
+    params = np.zeros((grid, grid, 4), dtype=np.float32)
+    # Line y = axis in block-local coordinates: 0 * x + 1 * y - axis = 0
+    params[..., 1], params[..., 2], params[..., 3] = 1, -axis, 1
+    params.reshape(-1, 4)[num_fibers:] = 0
+
+    return mask, Fitting((size, size), block, params)
+
+
+def benchmark_measure_fibers(fiber_counts=(10**4, 10**5), block=16, width=5, profile_radius=2):
+    """Time of `measure_fibers` for a number of fitted lines, and the error of the measured diameters."""
+    rows = []
+
+    for num_fibers in fiber_counts:
+        mask, fitting = parallel_fibers(num_fibers, block, width)
+        distance = distance_transform_edt(mask).astype(np.float32)
+        seconds, measured = best_time(measure_fibers, fitting, distance, profile_radius)
+
+        rows.append(
+            dict(
+                fibers=num_fibers,
+                measured=len(measured['diameter']),
+                seconds=seconds,
+                max_diameter_error=float(np.abs(measured['diameter'] - width).max()),
+            )
+        )
+
+    return rows
+
+
+if __name__ == '__main__':
+    print(f"{'fibers':>8} {'measured':>9} {'time, s':>8} {'max error, px':>14}")
+    for row in benchmark_measure_fibers():
+        print(f"{row['fibers']:>8} {row['measured']:>9} {row['seconds']:>8.4f} {row['max_diameter_error']:>14.2e}")
@@ -0,0 +1,70 @@
+from time import perf_counter
+
+import numpy as np
+
+from ..core.transforms import ExecutionContext
+from ..core.utils import available_cpus
+from .common import (
+    CHAIN_PARAMS,
+    FIBER_THICKNESS,
+    chain_handler,
+    check_nonempty,
+    fibers_for_density,
+    synthetic_fiber_image,
+)
+
+
+def default_thread_counts():
+    cpus = available_cpus()
+    counts = [2**i for i in range(cpus.bit_length()) if 2**i < cpus]
+
+    return counts + [cpus]
+
+
+def benchmark_thread_scaling(size=2048, fibers_per_mpx=300, thread_counts=None, repeat=3, params=CHAIN_PARAMS):
+    """
+    Time of every transform of the chain with `params` for every number of threads, and the speedup over one
+    thread. Raises `ValueError` when the synthetic image leaves a step of the chain without fibers.
+    """
+    thread_counts = thread_counts or default_thread_counts()
+    image = synthetic_fiber_image((size, size), fibers_for_density((size, size), fibers_per_mpx), FIBER_THICKNESS)
+
+    handler = chain_handler(image, params)
+    input_nodes = [handler.get_result_node(idx - 1) for idx in range(len(handler.transforms))]
+    check_nonempty(input_nodes + [handler.get_result_node(len(handler.transforms) - 1)])
+
+    rows = []
+    for transform, input_node in zip(handler.transforms, input_nodes):
+        single_thread_time = None
+
+        for threads in thread_counts:
+            transform.set_execution(ExecutionContext(threads))
+            best = float('inf')
+
+            for _ in range(repeat):
+                # Copied arrays, so that a call does not warm-start from the previous one
+                node = {
+                    name: np.array(value) if isinstance(value, np.ndarray) else value
+                    for name, value in input_node.items()
+                }
+                start = perf_counter()
+                transform(node)
+                best = min(best, perf_counter() - start)
+
+            single_thread_time = single_thread_time or best
+            rows.append(
+                dict(
+                    transform=transform.transform_name,
+                    threads=threads,
+                    seconds=best,
+                    speedup=single_thread_time / best,
+                )
+            )
+
+    return rows
+
+
+if __name__ == '__main__':
+    print(f"{'transform':>22} {'threads':>8} {'time, s':>9} {'speedup':>8}")
+    for row in benchmark_thread_scaling():
+        print(f"{row['transform']:>22} {row['threads']:>8} {row['seconds']:>9.4f} {row['speedup']:>8.2f}")
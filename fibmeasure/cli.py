@@ -0,0 +1,134 @@
+import argparse
+import json
+
+from .batch import load_params, run_batch
+from .sweep import load_grid, run_sweep, write_table
+from .core.transform_handler import DEFAULT_CACHE_BYTES, DEFAULT_DISK_CACHE_BYTES
+from .core.utils import parse_bytes
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='fibmeasure', description='Fiber measurement tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    batch = subparsers.add_parser('batch', help='Run the transform chain over a folder or glob of images')
+    batch.add_argument('inputs', nargs='+', help='Image files, directories or glob patterns')
+    batch.add_argument('-o', '--output', required=True, help='Directory for results and results.jsonl')
+    batch.add_argument('-p', '--params', help='Parameters YAML in the transform_views.yaml format')
+    batch.add_argument('-j', '--workers', type=int, help='Number of worker processes, defaults to the CPU count')
+    batch.add_argument(
+        '-t', '--threads', type=int, help='Threads per worker process, defaults to the CPU count divided by workers'
+    )
+    batch.add_argument('-m', '--memory-limit', type=parse_bytes, help='Memory budget for images in flight, e.g. 16G')
+    batch.add_argument('--outputs', nargs='+', help='Outputs of the last transform to save, defaults to all')
+    batch.add_argument('--tile-size', type=int, help='Process images out-of-core in tiles of this size')
+    batch.add_argument('--cache-dir', help='Directory for step outputs reused by reruns with changed parameters')
+    batch.add_argument(
+        '--cache-size', type=parse_bytes, default=DEFAULT_DISK_CACHE_BYTES, help='Size budget of --cache-dir, e.g. 16G'
+    )
+    batch.add_argument(
+        '--pixel-spacing', type=float, default=1.0, help='Physical size of a pixel, measurements are in its units'
+    )
+    batch.add_argument(
+        '--raw-shape', nargs=2, type=int, metavar=('HEIGHT', 'WIDTH'), help='Shape of headerless .raw images'
+    )
+    batch.add_argument('--raw-dtype', help='Pixel type of headerless .raw images, e.g. uint16')
+    batch.add_argument(
+        '--diameter-bin-width',
+        type=float,
+        help='Width of the diameter histogram bins in units of --pixel-spacing, defaults to half a pixel',
+    )
+
+    sweep = subparsers.add_parser('sweep', help='Run a grid of parameters over images and tabulate fiber metrics')
+    sweep.add_argument('inputs', nargs='+', help='Image files, directories or glob patterns')
+    sweep.add_argument(
+        '-g', '--grid', required=True, help='YAML of transform: {parameter: values, a count of slider values or null}'
+    )
+    sweep.add_argument('-o', '--output', required=True, help='CSV table with one row per image and combination')
+    sweep.add_argument('-p', '--params', help='Parameters YAML in the transform_views.yaml format')
+    sweep.add_argument('-j', '--workers', type=int, help='Number of worker processes, defaults to the CPU count')
+    sweep.add_argument(
+        '-t', '--threads', type=int, help='Threads per worker process, defaults to the CPU count divided by workers'
+    )
+    sweep.add_argument(
+        '-m',
+        '--memory-limit',
+        type=parse_bytes,
+        default=DEFAULT_CACHE_BYTES,
+        help='Memory budget for step outputs cached by all worker processes, e.g. 4G',
+    )
+    sweep.add_argument('--cache-dir', help='Directory for step outputs shared by the worker processes')
+    sweep.add_argument(
+        '--cache-size', type=parse_bytes, default=DEFAULT_DISK_CACHE_BYTES, help='Size budget of --cache-dir, e.g. 16G'
+    )
+    sweep.add_argument(
+        '--pixel-spacing', type=float, default=1.0, help='Physical size of a pixel, measurements are in its units'
+    )
+    sweep.add_argument(
+        '--raw-shape', nargs=2, type=int, metavar=('HEIGHT', 'WIDTH'), help='Shape of headerless .raw images'
+    )
+    sweep.add_argument('--raw-dtype', help='Pixel type of headerless .raw images, e.g. uint16')
+    sweep.add_argument(
+        '--diameter-bin-width',
+        type=float,
+        help='Width of the diameter histogram bins in units of --pixel-spacing, defaults to half a pixel',
+    )
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    if args.command == 'batch':
+        records = run_batch(
+            args.inputs,
+            args.output,
+            config=load_params(args.params),
+            workers=args.workers,
+            memory_limit=args.memory_limit,
+            output_names=args.outputs,
+            tile_size=args.tile_size,
+            threads=args.threads,
+            cache_dir=args.cache_dir,
+            cache_bytes=args.cache_size,
+            pixel_spacing=args.pixel_spacing,
+            raw_shape=args.raw_shape,
+            raw_dtype=args.raw_dtype,
+            diameter_bin_width=args.diameter_bin_width,
+        )
+
+        failed = [record for record in records if record['status'] != 'ok']
+        for record in failed:
+            print(f"{record['image']}: {record['error']}")
+        print(json.dumps({'processed': len(records), 'failed': len(failed)}))
+
+        return 1 if failed else 0
+
+    if args.command == 'sweep':
+        rows = run_sweep(
+            args.inputs,
+            load_grid(args.grid),
+            config=load_params(args.params),
+            workers=args.workers,
+            threads=args.threads,
+            cache_dir=args.cache_dir,
+            cache_bytes=args.cache_size,
+            pixel_spacing=args.pixel_spacing,
+            raw_shape=args.raw_shape,
+            raw_dtype=args.raw_dtype,
+            memory_limit=args.memory_limit,
+            diameter_bin_width=args.diameter_bin_width,
+        )
+        write_table(rows, args.output)
+
+        failed = {row['image']: row['error'] for row in rows if row['status'] != 'ok'}
+        for image, error in failed.items():
+            print(f'{image}: {error}')
+        print(json.dumps({'rows': len(rows), 'failed_images': len(failed)}))
+
+        return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
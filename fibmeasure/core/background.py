@@ -0,0 +1,70 @@
+import threading
+import traceback
+
+
+class Cancelled(Exception):
+    """Raised by a job that stopped early because a newer job superseded it."""
+
+
+class LatestJobWorker:
+    """
+    Runs jobs one at a time on a background thread, only the latest submitted job is of interest.
+
+    A submitted job supersedes the queued one, a running job sees it through the `cancelled` callable
+    it is called with and may stop early by raising `Cancelled`. Callbacks of superseded jobs are not called.
+    Updates are never dropped, every update is applied in the submission order before the next job runs,
+    so state that jobs read is only changed between jobs.
+    """
+
+    def __init__(self, name='latest-job-worker'):
+        self._condition = threading.Condition()
+        self._generation = 0
+        self._updates = []
+        self._job = None
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def submit(self, job, callback=None, update=None):
+        """
+        Schedules `job(cancelled)` after `update()`, `callback(result)` is called on the worker thread
+        if no newer job was submitted by the time the job finishes. Returns the generation of the job.
+        """
+        with self._condition:
+            if update is not None:
+                self._updates.append(update)
+
+            self._generation += 1
+            self._job = (self._generation, job, callback)
+            self._condition.notify()
+
+            return self._generation
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._job is None:
+                    self._condition.wait()
+
+                (generation, job, callback), self._job = self._job, None
+                updates, self._updates = self._updates, []
+
+            def cancelled():
+                return generation != self._generation
+
+            try:
+                for update in updates:
+                    update()
+
+                result = job(cancelled)
+                if callback is not None and not cancelled():
+                    callback(result)
+            except Cancelled:
+                pass
+            except Exception:
+                # The worker outlives a failed job, the next submission gets a fresh start
+                traceback.print_exc()
@@ -1,6 +1,8 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from dataclasses import dataclass
 from inspect import signature, isfunction
-from typing import Any, Callable, List
+from types import CodeType
+from typing import Any, Callable, FrozenSet, List
 
 
 type Output = Any
@@ -11,17 +13,80 @@ class TransformSpec:
     method: Callable
     dependencies: List[str]
     params: List[str]
+    attributes: FrozenSet[str]
+    # Params with a default value, those may be missing from the inputs
+    optional: FrozenSet[str] = frozenset()
+
+
+def reads(*attributes):
+    """Declare instance attributes a transform method reads, instead of introspecting its code."""
+
+    def decorator(method):
+        method.__transform_reads__ = frozenset(attributes)
+        return method
+
+    return decorator
+
+
+def _read_attributes(cls, method):
+    """
+    Names a method may read from `self`, a superset collected from the bytecode of the method,
+    its nested functions and the class methods and properties it refers to.
+    """
+    if hasattr(method, '__transform_reads__'):
+        return method.__transform_reads__
+
+    names, visited = set(), set()
+    codes = [method.__code__]
+
+    while codes:
+        code = codes.pop()
+        if code in visited:
+            continue
+        visited.add(code)
+
+        names.update(code.co_names)
+        codes.extend(const for const in code.co_consts if isinstance(const, CodeType))
+
+        for name in code.co_names:
+            member = getattr(cls, name, None)
+            if isinstance(member, property):
+                member = member.fget
+            if isfunction(member):
+                codes.append(member.__code__)
+
+    return frozenset(names)
+
+
+def _topological_order(cls_name, name2transform_spec):
+    order = []
+    pending = {name: set(spec.dependencies) for name, spec in name2transform_spec.items()}
+
+    while pending:
+        ready = [name for name, deps in pending.items() if not deps - set(order)]
+        if not ready:
+            raise RuntimeError(f"{cls_name} has cyclic Output dependencies between {', '.join(sorted(pending))}.")
+
+        for name in ready:
+            order.append(name)
+            del pending[name]
+
+    return order
 
 
 class Transform:
     """
     Base class for defining data transformations with declarative dependencies.
 
-    A transformation is defined as a method of a subclass. 
-    Methods can depend on outputs of other methods via `Output` annotation.
-    Supports only depth-1 dependencies (Output of Output not allowed).
+    A transformation is defined as a method of a subclass.
+    Methods can depend on outputs of other methods via `Output` annotation, with any depth.
+    Other parameters are taken from the inputs, those with a default value may be missing.
+    Methods that do not depend on each other run concurrently on a thread pool of `max_workers` threads.
+    Each method records the instance attributes it reads, see `stale_outputs`.
     """
     _name2transform_spec: dict[str, TransformSpec] = {}
+    _transform_order: list[str] = []
+    max_workers: int | None = None
 
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
@@ -33,14 +98,18 @@ class Transform:
         for name, method in cls.__dict__.items():
             if isfunction(method) and not name.startswith("_"):
                 sig = signature(method)
-                deps, params = [], []
+                deps, params, optional = [], [], set()
                 for param in sig.parameters.values():
                     if param.annotation == Output:
                         deps.append(param.name)
                     else:
                         params.append(param.name)
+                        if param.default is not param.empty:
+                            optional.add(param.name)
 
-                cls._name2transform_spec[name] = TransformSpec(method, deps, params)
+                cls._name2transform_spec[name] = TransformSpec(
+                    method, deps, params, _read_attributes(cls, method), frozenset(optional)
+                )
 
         # validate dependencies
         for name, spec in cls._name2transform_spec.items():
@@ -51,40 +120,83 @@ class Transform:
                         f"but no method '{dep}' is defined."
                     )
 
-                if cls._name2transform_spec[dep].dependencies:
-                    raise RuntimeError(
-                        f"{cls.__name__}.{name} requires '{dep}', but '{dep}' "
-                        f"also requires an Output (depth > 1 not allowed)."
-                    )
+        cls._transform_order = _topological_order(cls.__name__, cls._name2transform_spec)
 
-    def _run_transforms(self, inputs, outputs, require_output: bool):
-        for name, spec in self._name2transform_spec.items():
-            if (len(spec.dependencies) != 0) != require_output:
-                continue
+    def _transform_params(self, name, inputs, outputs):
+        spec = self._name2transform_spec[name]
 
-            params = {}
-            for dep in spec.dependencies:
-                if dep not in outputs:
-                    raise ValueError(f"{name} depends on missing output '{dep}'")
+        params = {}
+        for dep in spec.dependencies:
+            if dep not in outputs:
+                raise ValueError(f"{name} depends on missing output '{dep}'")
 
-                params[dep] = outputs[dep]
+            params[dep] = outputs[dep]
+
+        for p in spec.params:
+            if p == "self":
+                continue
 
-            for p in spec.params:
-                if p == "self":
+            if p not in inputs:
+                if p in spec.optional:
                     continue
 
-                if p not in inputs:
-                    raise ValueError(f"{self.__class__.__name__}.{name} requires '{p}'")
+                raise ValueError(f"{self.__class__.__name__}.{name} requires '{p}'")
 
-                params[p] = inputs[p]
+            params[p] = inputs[p]
 
-            outputs[name] = spec.method(self, **params)
+        return params
 
-    def __call__(self, inputs: dict[str, Any]) -> dict[str, Any]:
-        outputs = {}
-        self._run_transforms(inputs, outputs, require_output=False)
-        self._run_transforms(inputs, outputs, require_output=True)
+    def stale_outputs(self, changed_attributes=(), changed_inputs=()):
+        """Outputs that have to be recomputed after the given attributes and inputs have changed."""
+        changed_attributes, changed_inputs = set(changed_attributes), set(changed_inputs)
+        stale = set()
+
+        for name in self._transform_order:
+            spec = self._name2transform_spec[name]
+            if (
+                spec.attributes & changed_attributes
+                or changed_inputs.intersection(spec.params)
+                or stale.intersection(spec.dependencies)
+            ):
+                stale.add(name)
+
+        return stale
+
+    def _run_transforms(self, inputs, outputs):
+        if self.max_workers == 1 or len(self._transform_order) == 1:
+            for name in self._transform_order:
+                if name in outputs:
+                    continue
+
+                params = self._transform_params(name, inputs, outputs)
+                outputs[name] = self._name2transform_spec[name].method(self, **params)
+
+            return
 
+        pending = {
+            name: set(self._name2transform_spec[name].dependencies)
+            for name in self._transform_order
+            if name not in outputs
+        }
+        running = {}
+
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            while pending or running:
+                for name in [name for name, deps in pending.items() if deps.issubset(outputs)]:
+                    params = self._transform_params(name, inputs, outputs)
+                    running[executor.submit(self._name2transform_spec[name].method, self, **params)] = name
+                    del pending[name]
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    outputs[running.pop(future)] = future.result()
+
+    def __call__(self, inputs: dict[str, Any], reuse: dict[str, Any] | None = None) -> dict[str, Any]:
+        """`reuse` holds outputs of a previous call that are still valid, they are not recomputed."""
+        outputs = {name: value for name, value in (reuse or {}).items() if name in self._name2transform_spec}
+        self._run_transforms(inputs, outputs)
+
+        outputs = {name: outputs[name] for name in self._transform_order}
         for k, v in inputs.items():
             outputs.setdefault(k, v)
 
@@ -0,0 +1,217 @@
+import os
+import pickle
+import shutil
+import tempfile
+from collections import OrderedDict
+from dataclasses import dataclass, fields, is_dataclass
+from pathlib import Path
+
+import numpy as np
+
+
+# Packed masks are unpacked into a given array in chunks of this many pixels
+UNPACK_CHUNK_PIXELS = 2**23
+
+
+def nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+
+    if is_dataclass(value):
+        return sum(nbytes(getattr(value, field.name)) for field in fields(value))
+
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(item) for item in value)
+
+    if isinstance(value, dict):
+        return sum(nbytes(item) for item in value.values())
+
+    return getattr(value, 'nbytes', 0)
+
+
+@dataclass(frozen=True)
+class PackedMask:
+    """Boolean mask stored with one bit per pixel."""
+
+    bits: np.ndarray
+    shape: tuple
+
+    @classmethod
+    def pack(cls, mask):
+        return cls(np.packbits(mask, axis=None), mask.shape)
+
+    def unpack(self, out=None):
+        """The mask, unpacked into `out` chunk by chunk if given, e.g. into a memory map without a full copy."""
+        size = int(np.prod(self.shape))
+        if out is None:
+            return np.unpackbits(self.bits, count=size).view(bool).reshape(self.shape)
+
+        flat = out.reshape(-1).view(np.uint8)
+        for start in range(0, size, UNPACK_CHUNK_PIXELS):
+            stop = min(start + UNPACK_CHUNK_PIXELS, size)
+            # Chunks start on byte boundaries
+            flat[start:stop] = np.unpackbits(self.bits[start // 8 : -(-stop // 8)], count=stop - start)
+
+        return out
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+
+class LRUCache:
+    """Least recently used cache bounded by the total size of its values in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        if key not in self._entries:
+            return default
+
+        self._entries.move_to_end(key)
+
+        return self._entries[key][0]
+
+    def values(self):
+        return [value for value, _ in self._entries.values()]
+
+    def put(self, key, value, size=None):
+        if key in self._entries:
+            self.pop(key)
+
+        size = nbytes(value) if size is None else size
+        self._entries[key] = (value, size)
+        self.nbytes += size
+
+        self._evict()
+
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def _evict(self):
+        # The newest entry is kept even if it exceeds the budget alone
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            self.pop(next(iter(self._entries)))
+
+    def pop(self, key, default=None):
+        if key not in self._entries:
+            return default
+
+        value, size = self._entries.pop(key)
+        self.nbytes -= size
+
+        return value
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+
+class DiskCache:
+    """
+    Directory of entries bounded by their total size in bytes, least recently used entries are removed first.
+
+    An entry holds named values: arrays are stored as `.npy` files and read back memory-mapped copy-on-write,
+    other values, e.g. packed masks and component tables, are pickled. Entries are written to a temporary
+    directory and renamed into place, so processes sharing the directory never read a partial entry.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def __contains__(self, key):
+        return (self.directory / key).is_dir()
+
+    def get(self, key, default=None):
+        path = self.directory / key
+        values = {}
+
+        try:
+            for file in path.iterdir():
+                if file.suffix == '.npy':
+                    values[file.stem] = np.load(file, mmap_mode='c')
+                else:
+                    with open(file, 'rb') as stream:
+                        values[file.stem] = pickle.load(stream)
+
+            # Modification time of the entry directory orders entries for eviction
+            os.utime(path)
+        except OSError:
+            # Missing, or evicted by another process while being read
+            return default
+
+        return values
+
+    def put(self, key, values):
+        path = self.directory / key
+        if path.is_dir():
+            return
+
+        tmp_path = Path(tempfile.mkdtemp(dir=self.directory, prefix='.tmp-'))
+        try:
+            for name, value in values.items():
+                if isinstance(value, np.ndarray):
+                    np.save(tmp_path / f'{name}.npy', value)
+                else:
+                    with open(tmp_path / f'{name}.pkl', 'wb') as stream:
+                        pickle.dump(value, stream, protocol=pickle.HIGHEST_PROTOCOL)
+
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process stored the same entry first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+
+        self._evict(keep=path)
+
+    def _evict(self, keep):
+        entries = []
+        for path in self.directory.iterdir():
+            if path.name.startswith('.tmp-'):
+                continue
+
+            try:
+                entries.append((path.stat().st_mtime, sum(file.stat().st_size for file in path.iterdir()), path))
+            except OSError:
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+
+            # The newest entry is kept even if it exceeds the budget alone
+            if path == keep:
+                continue
+
+            if self._remove(path):
+                total -= size
+
+    def remove(self, key):
+        return self._remove(self.directory / key)
+
+    @staticmethod
+    def _remove(path):
+        # Renamed away first, so that readers see the entry either whole or missing, never partly removed
+        doomed = path.with_name(f'.tmp-removed-{os.getpid()}-{path.name}')
+        try:
+            os.rename(path, doomed)
+        except OSError:
+            # Removed by another process
+            return False
+
+        shutil.rmtree(doomed, ignore_errors=True)
+
+        return True
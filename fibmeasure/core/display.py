@@ -0,0 +1,224 @@
+import base64
+import io
+import math
+import weakref
+
+import numpy as np
+from PIL import Image
+
+from .cache import LRUCache
+
+
+DISPLAY_CACHE_BYTES = 64 * 1024**2
+DEFAULT_DISPLAY_SIZE = (1024, 1024)
+TILE_SIZE = 256
+PYRAMID_CACHE_BYTES = 64 * 1024**2
+# Pyramids of this many recently shown arrays are kept
+MAX_PYRAMIDS = 16
+# The display range of an image is taken from about this many evenly spaced pixels
+RANGE_SAMPLES = 2**20
+# zlib level 1 is several times faster than the default and nearly as small on masks
+PNG_COMPRESS_LEVEL = 1
+
+
+def mask_to_uint8(mask, factor=1):
+    """Boolean mask as 0 and 255, averaged over `factor` x `factor` blocks so that thin structures stay visible."""
+    image = Image.fromarray(np.multiply(mask, np.uint8(255), dtype=np.uint8))
+
+    return image.reduce(factor) if factor > 1 else image
+
+
+def sampled_range(image, num_samples=RANGE_SAMPLES):
+    step = max(1, math.isqrt(image.size // num_samples))
+    sampled = image[::step, ::step]
+
+    return float(sampled.min()), float(sampled.max())
+
+
+def grayscale_to_uint8(image, factor=1, value_range=None):
+    """
+    Any image stretched to 0..255 over `value_range`, its own range by default, downscaled `factor` times
+    beforehand. Values outside of the range are clipped.
+    """
+    if factor > 1:
+        # Every `factor // 2`-th pixel averaged in 2 x 2 blocks, a quarter of the samples of a full box filter
+        step = factor // 2
+        sampled = np.ascontiguousarray(image[::step, ::step], dtype=np.float32)
+        image = np.asarray(Image.fromarray(sampled).reduce(-(-factor // step)))
+
+    image_min, image_max = (float(image.min()), float(image.max())) if value_range is None else value_range
+    if image_max == image_min:
+        return Image.fromarray(np.zeros(image.shape, dtype=np.uint8))
+
+    scale = 255 / (image_max - image_min)
+    scaled = (image - image_min) * scale
+    if value_range is not None:
+        scaled = np.clip(scaled, 0, 255, out=scaled)
+
+    return Image.fromarray(scaled.astype(np.uint8))
+
+
+class ImagePyramid:
+    """
+    Display levels of an image, level `k` is `2**k` times smaller and split in `tile_size` tiles.
+
+    Tiles are converted to uint8 on first use straight from the image, so the cost of a view depends
+    on the size of the view and not on the size of the image. Views are addressed by the fraction
+    of the image at their center and the zoom over the view that fits the whole image.
+    The image is referenced weakly, `release` is called once it is garbage collected.
+    """
+
+    def __init__(self, image, tile_size=TILE_SIZE, cache_bytes=PYRAMID_CACHE_BYTES, release=None):
+        self._image = weakref.ref(image, release)
+        self.tile_size = tile_size
+        self._value_range = None
+        self._tiles = LRUCache(cache_bytes)
+
+    @property
+    def image(self):
+        """The image, None once it is released."""
+        return self._image()
+
+    @property
+    def num_levels(self):
+        """Levels down to the one that fits in a single tile."""
+        return max(1, math.ceil(math.log2(max(self.image.shape) / self.tile_size)) + 1)
+
+    @property
+    def value_range(self):
+        if self._value_range is None and self.image.dtype != bool:
+            self._value_range = sampled_range(self.image)
+
+        return self._value_range
+
+    def level_shape(self, level):
+        factor = 2**level
+
+        return -(-self.image.shape[0] // factor), -(-self.image.shape[1] // factor)
+
+    def tile(self, level, row, col):
+        key = (level, row, col)
+        tile = self._tiles.get(key)
+
+        if tile is None:
+            factor = 2**level
+            extent = self.tile_size * factor
+            crop = self.image[row * extent : (row + 1) * extent, col * extent : (col + 1) * extent]
+
+            if crop.dtype == bool:
+                tile = np.asarray(mask_to_uint8(crop, factor))
+            else:
+                tile = np.asarray(grayscale_to_uint8(crop, factor, self.value_range))
+            self._tiles.put(key, tile)
+
+        return tile
+
+    def region(self, level, top, bottom, left, right):
+        """Pixels of `level` in the box, assembled from tiles."""
+        size = self.tile_size
+        region = np.empty((bottom - top, right - left), dtype=np.uint8)
+
+        for row in range(top // size, -(-bottom // size)):
+            for col in range(left // size, -(-right // size)):
+                tile = self.tile(level, row, col)
+                y0, x0 = max(top, row * size), max(left, col * size)
+                y1, x1 = min(bottom, row * size + tile.shape[0]), min(right, col * size + tile.shape[1])
+                region[y0 - top : y1 - top, x0 - left : x1 - left] = tile[
+                    y0 - row * size : y1 - row * size, x0 - col * size : x1 - col * size
+                ]
+
+        return region
+
+    def view(self, size, zoom=1.0, center=(0.5, 0.5)):
+        """
+        `(level, top, bottom, left, right)` of the view of a `size`, (width, height), screen box: the coarsest level
+        with at least one pixel per screen pixel, and the visible box in its pixels, shifted to stay in the image.
+        """
+        width, height = size
+        # Image pixels per screen pixel
+        scale = max(self.image.shape[0] / height, self.image.shape[1] / width) / max(zoom, 1.0)
+        level = min(max(0, math.floor(math.log2(scale))) if scale >= 1 else 0, self.num_levels - 1)
+        factor = 2**level
+        level_height, level_width = self.level_shape(level)
+
+        box_height = min(level_height, math.ceil(height * scale / factor))
+        box_width = min(level_width, math.ceil(width * scale / factor))
+        top = min(max(0, round(center[0] * level_height - box_height / 2)), level_height - box_height)
+        left = min(max(0, round(center[1] * level_width - box_width / 2)), level_width - box_width)
+
+        return level, top, top + box_height, left, left + box_width
+
+
+class DisplayEncoder:
+    """
+    Base64 views of images for the screen, taken from the `ImagePyramid` level that matches `max_size`.
+
+    Masks are encoded as PNG, other images as `image_format`, 'JPEG' or 'PNG', noisy grayscale images
+    compress poorly and JPEG encodes them an order of magnitude faster. Pyramids and encoded views are cached
+    by the identity of the array, so panes showing the same result share its pyramid and a view that
+    did not change is not encoded again. Arrays are not kept alive by the encoder, the pyramid of an array
+    is dropped once the array is released, e.g. evicted from the cache of a `TransformHandler`.
+    """
+
+    def __init__(
+        self, max_size=DEFAULT_DISPLAY_SIZE, image_format='JPEG', jpeg_quality=90, cache_bytes=DISPLAY_CACHE_BYTES
+    ):
+        self.max_size = max_size
+        self.image_format = image_format
+        self.jpeg_quality = jpeg_quality
+        self._cache = LRUCache(cache_bytes)
+        self._pyramids = LRUCache(MAX_PYRAMIDS)
+
+    def __call__(self, image, max_size=None, zoom=1.0, center=(0.5, 0.5)):
+        """The view of `image` in a `max_size` box, see `ImagePyramid.view`."""
+        max_size = self.max_size if max_size is None else tuple(max_size)
+        pyramid = self.pyramid(image)
+        box = pyramid.view(max_size, zoom, center)
+        key = (id(image), box, max_size, self.image_format)
+
+        cached = self._cache.get(key)
+        # An id is reused once its array is released, the weak reference tells the arrays apart
+        if cached is not None and cached[0]() is image:
+            return cached[1]
+
+        encoded = self.encode(pyramid.region(*box), max_size, mask=image.dtype == bool)
+        self._cache.put(key, (weakref.ref(image), encoded), size=len(encoded))
+
+        return encoded
+
+    def pyramid(self, image):
+        key = id(image)
+        cached = self._pyramids.get(key)
+        if cached is not None and cached.image is image:
+            return cached
+
+        pyramids = self._pyramids
+
+        def release(_):
+            # Called after the reference is cleared, a pyramid of a newer array with the same id is kept
+            pyramid = pyramids.get(key)
+            if pyramid is not None and pyramid.image is None:
+                pyramids.pop(key)
+
+        pyramid = ImagePyramid(image, release=release)
+        self._pyramids.put(key, pyramid, size=1)
+
+        return pyramid
+
+    def encode(self, region, max_size, mask=False):
+        """Encodes a uint8 region, downscaled to fit `max_size`."""
+        image = Image.fromarray(region)
+        ratio = max(region.shape[0] / max_size[1], region.shape[1] / max_size[0])
+        if ratio > 1:
+            # Less than 2 after the pyramid level, an interpolating resize keeps the view as large as the pane
+            image = image.resize(
+                (max(1, round(region.shape[1] / ratio)), max(1, round(region.shape[0] / ratio))), Image.Resampling.BOX
+            )
+
+        buffer = io.BytesIO()
+        if mask or self.image_format == 'PNG':
+            image.save(buffer, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+        else:
+            image.save(buffer, format='JPEG', quality=self.jpeg_quality)
+
+        return base64.b64encode(buffer.getvalue()).decode('utf-8')
@@ -0,0 +1,48 @@
+import numpy as np
+from imops.morphology import distance_transform_edt
+from scipy import ndimage
+from skimage.morphology import disk
+
+
+# Disks at least this large are handled through the distance transform, smaller ones by the footprint directly.
+# imops morphology is not used, it misses isolated pixels of dense masks
+EDT_MIN_RADIUS = 4
+
+
+def _disk_distance(radius):
+    # Squared distances between pixels are integers, so `distance < sqrt(radius² + 1/2)` selects exactly `disk(radius)`
+    return np.sqrt(radius**2 + 0.5)
+
+
+def disk_erosion(mask, radius, num_threads=-1):
+    """
+    Binary erosion by `disk(radius)`, pixels outside the image count as foreground, same as
+    `skimage.morphology.binary_erosion`. Large disks threshold the distance to the background.
+    """
+    if radius == 0:
+        return mask.copy()
+
+    if radius < EDT_MIN_RADIUS:
+        return ndimage.binary_erosion(mask, disk(radius), border_value=1)
+
+    return distance_transform_edt(mask, num_threads=num_threads) > _disk_distance(radius)
+
+
+def disk_dilation(mask, radius, num_threads=-1):
+    """Binary dilation by `disk(radius)`, large disks threshold the distance to the foreground."""
+    if radius == 0:
+        return mask.copy()
+
+    if radius < EDT_MIN_RADIUS:
+        return ndimage.binary_dilation(mask, disk(radius))
+
+    return distance_transform_edt(~mask, num_threads=num_threads) < _disk_distance(radius)
+
+
+def disk_opening(mask, radius, num_threads=-1):
+    """
+    Binary opening by `disk(radius)`, equal to `skimage.morphology.binary_opening` pixel for pixel.
+
+    With the distance transform backend the cost does not depend on the radius.
+    """
+    return disk_dilation(disk_erosion(mask, radius, num_threads), radius, num_threads)
@@ -1,5 +1,9 @@
 from dataclasses import dataclass
+from functools import cached_property
+
 import numpy as np
+from imops import label
+from scipy import ndimage
 
 
 def line_params_tls(x, y):
@@ -25,62 +29,450 @@ class Fitting:
     fitting_blocked_params: np.ndarray
 
 
-def blocked_line_fitting_tls(skeleton, linearity_thr=100.0, block=16, filtration_image=None, filtration_thr=0.8, dist_thr=2):
-    H, W = skeleton.shape
+@dataclass
+class BlockMoments:
+    count: np.ndarray
+    sum_x: np.ndarray
+    sum_y: np.ndarray
+    sum_xx: np.ndarray
+    sum_xy: np.ndarray
+    sum_yy: np.ndarray
+
 
+def block_grid_shape(shape, block):
     half_block = block // 2
+    H, W = shape
 
-    H_block = (H + half_block - 1) // half_block
-    W_block = (W + half_block - 1) // half_block
-    fitting_blocked_params = np.zeros((H_block, W_block, 4), dtype=np.float32)
+    return (H + half_block - 1) // half_block, (W + half_block - 1) // half_block
 
-    for i in range(H_block):
-        for j in range(W_block):
-            crop = skeleton[i * half_block : (i + 2) * half_block, j * half_block : (j + 2) * half_block]
 
-            if crop.sum() >= 4:
-                y, x = np.where(crop)
+def block_moments(skeleton, block):
+    """
+    Pixel count and coordinate sums of every half-overlapping block, in block-local coordinates.
 
-                A, B, C, linearity = line_params_tls(x, y)
+    Moments are accumulated over non-overlapping `block // 2` cells and every block is combined
+    from its 2x2 cells, shifting the coordinate origin of each cell to the block corner.
+    """
+    half_block = block // 2
+    H_block, W_block = block_grid_shape(skeleton.shape, block)
+    cells_shape = (H_block + 1, W_block + 1)
 
-                if linearity >= linearity_thr:
-                    if filtration_image is None:
-                        fitting_blocked_params[i, j] = np.asarray([A, B, C, 1])
-                    else:
-                        x_c, y_c = np.arange(block), np.arange(block)
-                        block_lin_interp = np.abs(A * x_c[None, :] + B * y_c[:, None] + C) < dist_thr
+    y, x = np.nonzero(skeleton)
+    cell_y, y = np.divmod(y, half_block)
+    cell_x, x = np.divmod(x, half_block)
+    cell_idx = cell_y * cells_shape[1] + cell_x
 
-                        filtration_crop = filtration_image[
-                            i * half_block : (i + 2) * half_block, j * half_block : (j + 2) * half_block
-                        ]
-                        assign_size = filtration_crop.shape
-                        block_lin_interp = block_lin_interp[: assign_size[0], : assign_size[1]]
+    def cell_sum(weights=None):
+        return np.bincount(cell_idx, weights, minlength=np.prod(cells_shape)).reshape(cells_shape).astype(np.float64)
 
-                        if block_lin_interp.sum() * filtration_thr <= (filtration_crop & block_lin_interp).sum():
-                            fitting_blocked_params[i, j] = np.asarray([A, B, C, 1])
+    n, sx, sy = cell_sum(), cell_sum(x), cell_sum(y)
+    sxx, sxy, syy = cell_sum(x * x), cell_sum(x * y), cell_sum(y * y)
 
-    return Fitting(skeleton.shape, block, fitting_blocked_params)
+    moments = BlockMoments(*(np.zeros((H_block, W_block)) for _ in range(6)))
+    for dy in (0, 1):
+        for dx in (0, 1):
+            cell = (slice(dy, dy + H_block), slice(dx, dx + W_block))
+            oy, ox = dy * half_block, dx * half_block
+
+            moments.count += n[cell]
+            moments.sum_x += sx[cell] + ox * n[cell]
+            moments.sum_y += sy[cell] + oy * n[cell]
+            moments.sum_xx += sxx[cell] + 2 * ox * sx[cell] + ox * ox * n[cell]
+            moments.sum_xy += sxy[cell] + ox * sy[cell] + oy * sx[cell] + ox * oy * n[cell]
+            moments.sum_yy += syy[cell] + 2 * oy * sy[cell] + oy * oy * n[cell]
+
+    return moments
+
+
+class MomentIndex:
+    """
+    Summed-area tables of pixel count and coordinate moments of a skeleton, built once.
+
+    Tables are sampled every `cell` pixels, so blocks with `block // 2` divisible by `cell`
+    are fitted from four table lookups per block without touching the skeleton pixels.
+    With `compact` the tables are stored as uint32 modulo 2^32: block-local moments of blocks smaller
+    than `COMPACT_MAX_BLOCK` stay below 2^32, so they are recovered exactly from wrapped sums.
+    """
+
+    COMPACT_MAX_BLOCK = 256
+
+    def __init__(self, skeleton, cell=2, compact=False):
+        self.shape = skeleton.shape
+        self.cell = cell
+        self.compact = compact
+
+        H, W = skeleton.shape
+        cells_shape = ((H + cell - 1) // cell, (W + cell - 1) // cell)
+
+        y, x = np.nonzero(skeleton)
+        cell_idx = (y // cell) * cells_shape[1] + x // cell
+
+        self._tables = []
+        for weights in (None, x, y, x * x, x * y, y * y):
+            table = np.zeros((cells_shape[0] + 1, cells_shape[1] + 1), dtype=np.int64)
+            table[1:, 1:] = np.bincount(cell_idx, weights, minlength=np.prod(cells_shape)).reshape(cells_shape)
+            table.cumsum(axis=0, out=table)
+            table.cumsum(axis=1, out=table)
+            self._tables.append(table.astype(np.uint32) if compact else table)
+
+    @property
+    def nbytes(self):
+        return sum(table.nbytes for table in self._tables)
+
+    def supports(self, block):
+        return (block // 2) % self.cell == 0 and (not self.compact or block < self.COMPACT_MAX_BLOCK)
+
+    def block_moments(self, block):
+        if not self.supports(block):
+            raise ValueError(f'Block {block} is not aligned with the index cell {self.cell}')
+
+        half_block = block // 2
+        H_block, W_block = block_grid_shape(self.shape, block)
+        step = half_block // self.cell
+        cells_H, cells_W = self._tables[0].shape[0] - 1, self._tables[0].shape[1] - 1
+
+        y0, x0 = np.arange(H_block) * step, np.arange(W_block) * step
+        y1, x1 = np.minimum(y0 + 2 * step, cells_H), np.minimum(x0 + 2 * step, cells_W)
+
+        def box_sum(table):
+            corners = [table[np.ix_(y, x)].astype(np.int64) for y, x in ((y1, x1), (y0, x1), (y1, x0), (y0, x0))]
+
+            return corners[0] - corners[1] - corners[2] + corners[3]
+
+        n, sx, sy, sxx, sxy, syy = map(box_sum, self._tables)
+
+        # Shift from image to block-local coordinates, exact in integers
+        oy = (np.arange(H_block) * half_block)[:, None]
+        ox = (np.arange(W_block) * half_block)[None, :]
+
+        moments = (
+            n,
+            sx - ox * n,
+            sy - oy * n,
+            sxx - 2 * ox * sx + ox * ox * n,
+            sxy - ox * sy - oy * sx + ox * oy * n,
+            syy - 2 * oy * sy + oy * oy * n,
+        )
+        if self.compact:
+            moments = (moment % 2**32 for moment in moments)
 
+        return BlockMoments(*(moment.astype(np.float64) for moment in moments))
 
-def visualize_fitting(fitting, dist_thr=2):
-    block = fitting.block_size
+
+def line_params_tls_batched(moments):
+    """
+    Closed-form `line_params_tls` for every block at once.
+
+    `(A, B, C)` and `(-A, -B, -C)` describe the same line and the sign may differ from `line_params_tls`,
+    `np.linalg.eigh` does not fix it. Axis-aligned lines get non-negative `A` and `B`.
+    """
+    count = np.maximum(moments.count, 1)
+    x_mean, y_mean = moments.sum_x / count, moments.sum_y / count
+
+    # Integer-valued sums keep the scatter matrix exact, so axis-aligned lines stay axis-aligned
+    cxx = (count * moments.sum_xx - moments.sum_x * moments.sum_x) / count
+    cyy = (count * moments.sum_yy - moments.sum_y * moments.sum_y) / count
+    cxy = (count * moments.sum_xy - moments.sum_x * moments.sum_y) / count
+
+    half_trace = (cxx + cyy) / 2
+    disc = np.hypot((cxx - cyy) / 2, cxy)
+    eig_min, eig_max = half_trace - disc, half_trace + disc
+
+    # Eigenvector of the smallest eigenvalue, taken from the better conditioned row
+    use_first_row = cxx > cyy
+    A = np.where(use_first_row, cxy, eig_min - cyy)
+    B = np.where(use_first_row, eig_min - cxx, cxy)
+
+    norm = np.hypot(A, B)
+    isotropic = norm == 0
+    A = np.where(isotropic, 1.0, A / np.where(isotropic, 1.0, norm))
+    B = np.where(isotropic, 0.0, B / np.where(isotropic, 1.0, norm))
+
+    axis_aligned = cxy == 0
+    A = np.where(axis_aligned, np.abs(A), A)
+    B = np.where(axis_aligned, np.abs(B), B)
+
+    C = -A * x_mean - B * y_mean
+    linearity = eig_max / np.maximum(eig_min, 1e-9)
+
+    return A, B, C, linearity
+
+
+def block_line_masks(A, B, C, size, dist_thr=2):
+    coords = np.arange(size)
+
+    return (
+        np.abs(A[:, None, None] * coords[None, None, :] + B[:, None, None] * coords[None, :, None] + C[:, None, None])
+        < dist_thr
+    )
+
+
+def _filter_by_recall(valid, A, B, C, filtration_image, block, filtration_thr, dist_thr, chunk_pixels=2**24):
     half_block = block // 2
-    fitting_blocked_params = fitting.fitting_blocked_params
-    H_block, W_block = fitting.fitting_blocked_params.shape[:-1]
+    size = 2 * half_block
+    H, W = filtration_image.shape
+
+    ii, jj = np.nonzero(valid)
+    coords = np.arange(size)
+    chunk = max(1, chunk_pixels // (size * size))
+
+    for start in range(0, len(ii), chunk):
+        i, j = ii[start : start + chunk], jj[start : start + chunk]
+
+        lines = block_line_masks(A[i, j], B[i, j], C[i, j], size, dist_thr)
+        # Blocks on the bottom/right border are cropped by the image
+        lines &= coords[None, :, None] < (H - i * half_block)[:, None, None]
+        lines &= coords[None, None, :] < (W - j * half_block)[:, None, None]
+
+        # Out of image pixels are clamped to the border, they are masked out of `lines` anyway
+        rows = np.minimum(i[:, None] * half_block + coords, H - 1)
+        cols = np.minimum(j[:, None] * half_block + coords, W - 1)
+        crops = filtration_image[rows[:, :, None], cols[:, None, :]]
+
+        line_size = lines.sum(axis=(1, 2))
+        hits = (lines & crops).sum(axis=(1, 2))
+
+        rejected = line_size * filtration_thr > hits
+        valid[i[rejected], j[rejected]] = False
+
+    return valid
+
+
+def blocked_line_fitting_tls(
+    skeleton, linearity_thr=100.0, block=16, filtration_image=None, filtration_thr=0.8, dist_thr=2, moment_index=None
+):
+    if moment_index is not None and moment_index.supports(block):
+        moments = moment_index.block_moments(block)
+    else:
+        moments = block_moments(skeleton, block)
+    A, B, C, linearity = line_params_tls_batched(moments)
+
+    valid = (moments.count >= 4) & (linearity >= linearity_thr)
+    if filtration_image is not None:
+        valid = _filter_by_recall(valid, A, B, C, filtration_image, block, filtration_thr, dist_thr)
+
+    fitting_blocked_params = np.zeros((*valid.shape, 4), dtype=np.float32)
+    fitting_blocked_params[valid] = np.stack([A[valid], B[valid], C[valid], np.ones(valid.sum())], axis=-1)
+
+    return Fitting(skeleton.shape, block, fitting_blocked_params)
+
+
+def _cell_owners(valid):
+    """
+    Offset (dy, dx) of the block that writes last into each half-block cell, -1 for empty cells.
+
+    Blocks are written in row-major order and every block overwrites its whole tile,
+    so a cell shows the last valid block among the four blocks covering it.
+    """
+    H_block, W_block = valid.shape
+    padded = np.pad(valid, ((1, 0), (1, 0)))
+
+    owner_dy = np.full(valid.shape, -1, dtype=np.int64)
+    owner_dx = np.full(valid.shape, -1, dtype=np.int64)
+    for dy, dx in ((1, 1), (1, 0), (0, 1), (0, 0)):
+        covered = padded[1 - dy : 1 - dy + H_block, 1 - dx : 1 - dx + W_block]
+        owner_dy[covered], owner_dx[covered] = dy, dx
+
+    return owner_dy, owner_dx
+
+
+def visualize_fitting(fitting, dist_thr=2, roi=None, chunk_pixels=2**24):
+    """
+    Rasterize fitted lines, equivalent to drawing every valid block tile in row-major order.
+
+    `roi` is a pair of slices `(rows, cols)`, only this part of the image is rasterized and returned.
+    """
+    H, W = fitting.origin_shape
+    half_block = fitting.block_size // 2
+    params = fitting.fitting_blocked_params.astype(np.float64)
+
+    if roi is None:
+        roi = (slice(None), slice(None))
+    (y0, y1, y_step), (x0, x1, x_step) = roi[0].indices(H), roi[1].indices(W)
+    if y_step != 1 or x_step != 1:
+        raise ValueError('roi slices must have unit step')
+    y1, x1 = max(y0, y1), max(x0, x1)
+
+    cy0, cy1 = y0 // half_block, (y1 + half_block - 1) // half_block
+    cx0, cx1 = x0 // half_block, (x1 + half_block - 1) // half_block
+    owner_dy, owner_dx = (owner[cy0:cy1, cx0:cx1] for owner in _cell_owners(params[..., 3] != 0))
+
+    cells = np.zeros((cy1 - cy0, half_block, cx1 - cx0, half_block), dtype=bool)
+    ci, cj = np.nonzero(owner_dy >= 0)
+    coords = np.arange(half_block)
+    chunk = max(1, chunk_pixels // (half_block * half_block))
+
+    for start in range(0, len(ci), chunk):
+        i, j = ci[start : start + chunk], cj[start : start + chunk]
+        dy, dx = owner_dy[i, j], owner_dx[i, j]
+        A, B, C = params[cy0 + i - dy, cx0 + j - dx, :3].T
+
+        # Coordinates of the cell pixels inside the owner block
+        x_c = dx[:, None] * half_block + coords
+        y_c = dy[:, None] * half_block + coords
+
+        cells[i, :, j, :] = (
+            np.abs(A[:, None, None] * x_c[:, None, :] + B[:, None, None] * y_c[:, :, None] + C[:, None, None])
+            < dist_thr
+        )
+
+    cells = cells.reshape((cy1 - cy0) * half_block, (cx1 - cx0) * half_block)
+
+    return cells[y0 - cy0 * half_block : y1 - cy0 * half_block, x0 - cx0 * half_block : x1 - cx0 * half_block]
+
+
+@dataclass
+class FiberSegmentTable:
+    """
+    One row per line fitted in a block, a fiber spanning several blocks has several rows. Positions and lengths
+    are in units of `pixel_spacing`, angles in radians in [0, pi).
+    """
+
+    x: np.ndarray
+    y: np.ndarray
+    angle: np.ndarray
+    length: np.ndarray
+    diameter: np.ndarray
+    pixel_spacing: float
+
+    def __len__(self):
+        return len(self.diameter)
+
+
+def measure_fibers(fitting, distance, profile_radius=2, chunk_samples=2**20):
+    """
+    Fiber diameter along every fitted line, in pixels, from the distance transform of the fiber mask.
+
+    Every line is sampled with unit steps inside the cells it is drawn in by `visualize_fitting`, so that
+    overlapping blocks do not measure the same pixels twice. At every station the distance transform is
+    maximized over a perpendicular profile of `profile_radius` pixels on both sides, which finds the fiber axis
+    when the fitted line is slightly off, and a station of distance `d` gives the diameter `2 * d - 1`.
+    Returns centers `x, y`, angles, lengths covered by the fiber and median diameters of lines with stations inside it.
+    """
+    H, W = fitting.origin_shape
+    block, half_block = fitting.block_size, fitting.block_size // 2
+    params = fitting.fitting_blocked_params.astype(np.float64)
+    valid = params[..., 3] != 0
+
+    owner_dy, owner_dx = _cell_owners(valid)
+    cell_y, cell_x = np.indices(valid.shape)
+    # Flat index of the block drawing each cell, -1 for empty cells
+    owner = np.where(owner_dy >= 0, (cell_y - owner_dy) * valid.shape[1] + (cell_x - owner_dx), -1)
+
+    block_idx = np.flatnonzero(valid)
+    A, B, C = params.reshape(-1, 4)[block_idx, :3].T
+    y0, x0 = np.divmod(block_idx, valid.shape[1])
+    y0, x0 = y0 * half_block, x0 * half_block
+
+    # Parametrize every line as p + t * (-B, A) with p the point closest to the block corner,
+    # and clip t to the part of the block inside the image
+    px, py, dx, dy = -A * C, -B * C, -B, A
+    t_lo, t_hi = np.full(len(A), -np.inf), np.full(len(A), np.inf)
+    for p, d, size in ((px, dx, np.minimum(block, W - x0)), (py, dy, np.minimum(block, H - y0))):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t0, t1 = -p / d, (size - 1 - p) / d
+        inside = (p >= 0) & (p <= size - 1)
+        t_lo = np.maximum(t_lo, np.where(d != 0, np.minimum(t0, t1), np.where(inside, -np.inf, np.inf)))
+        t_hi = np.minimum(t_hi, np.where(d != 0, np.maximum(t0, t1), np.where(inside, np.inf, -np.inf)))
+    # Lines missing the block get no stations
+    missed = ~(t_lo <= t_hi)
+    t_lo, t_hi = np.where(missed, 0, t_lo), np.where(missed, -1, t_hi)
+
+    # Unit steps along a line fit into the block diagonal
+    max_steps = int(np.ceil(block * np.sqrt(2))) + 1
+    offsets = np.arange(-profile_radius, profile_radius + 1)
+    flat_distance = np.asarray(distance).reshape(-1)
+    chunk = max(1, chunk_samples // max_steps)
+
+    columns = {name: np.zeros(len(A)) for name in ('x', 'y', 'length', 'diameter')}
+    for start in range(0, len(A), chunk):
+        lines = slice(start, start + chunk)
+        num_steps = int(np.max(t_hi[lines] - t_lo[lines], initial=-1)) + 1
+        t = t_lo[lines, None] + np.arange(num_steps)
+        station = t <= t_hi[lines, None]
+
+        sx = x0[lines, None] + px[lines, None] + t * dx[lines, None]
+        sy = y0[lines, None] + py[lines, None] + t * dy[lines, None]
+        ix, iy = np.rint(sx).astype(np.int64), np.rint(sy).astype(np.int64)
+        station &= (ix >= 0) & (ix < W) & (iy >= 0) & (iy < H)
+        ix, iy = np.where(station, ix, 0), np.where(station, iy, 0)
+        station &= owner[iy // half_block, ix // half_block] == block_idx[lines, None]
+
+        # Perpendicular profiles, clamped to the image
+        station_distance = np.zeros(t.shape, dtype=flat_distance.dtype)
+        for offset in offsets:
+            qx = np.rint(sx + offset * A[lines, None]).clip(0, W - 1).astype(np.int64)
+            qy = np.rint(sy + offset * B[lines, None]).clip(0, H - 1).astype(np.int64)
+            np.maximum(station_distance, flat_distance[qy * W + qx], out=station_distance)
+        station &= station_distance > 0
+
+        num_stations = station.sum(axis=1)
+        columns['length'][lines] = num_stations
+        with np.errstate(invalid='ignore'):
+            columns['x'][lines] = np.where(station, sx, 0).sum(axis=1) / num_stations
+            columns['y'][lines] = np.where(station, sy, 0).sum(axis=1) / num_stations
+        diameters = np.where(station, 2 * station_distance - 1, np.nan)
+        columns['diameter'][lines] = _nanmedian_rows(diameters)
+
+    measured = columns['length'] > 0
+    angle = np.mod(np.arctan2(dy, dx), np.pi)
+
+    return {
+        'x': columns['x'][measured],
+        'y': columns['y'][measured],
+        'angle': angle[measured],
+        'length': columns['length'][measured],
+        'diameter': columns['diameter'][measured],
+    }
+
+
+def _nanmedian_rows(values):
+    """Median of every row ignoring NaNs, NaN for rows without values, without warnings."""
+    count = np.sum(~np.isnan(values), axis=1)
+    # NaNs sort last, so the median is taken from the first `count` values of every sorted row
+    values = np.sort(values, axis=1)
+    rows = np.arange(len(values))
+    lo, hi = np.maximum(count - 1, 0) // 2, np.maximum(count, 1) // 2
+
+    return np.where(count > 0, (values[rows, lo] + values[rows, hi]) / 2, np.nan)
+
+
+@dataclass
+class ComponentTable:
+    """Connected components of a mask: the label image and the size of every label, labels start from 1."""
+
+    ccs: np.ndarray
+    sizes: np.ndarray
+
+    @property
+    def num_components(self):
+        return len(self.sizes)
+
+    @cached_property
+    def bboxes(self):
+        """Bounding box of every component as rows of `y0, x0, y1, x1`, stops excluded."""
+        objects = ndimage.find_objects(self.ccs, max_label=self.num_components)
+
+        return np.array([[rows.start, cols.start, rows.stop, cols.stop] for rows, cols in objects], dtype=np.int64)
+
+
+def smallest_uint_dtype(max_value):
+    return next(dtype for dtype in (np.uint8, np.uint16, np.uint32) if max_value <= np.iinfo(dtype).max)
 
-    result = np.zeros(fitting.origin_shape, dtype=bool)
-    for i in range(H_block):
-        for j in range(W_block):
-            A, B, C, valid = fitting_blocked_params[i, j]
 
-            if valid:
-                x_c, y_c = np.arange(block), np.arange(block)
-                block_lin_interp = np.abs(A * x_c[None, :] + B * y_c[:, None] + C) < dist_thr
+def component_table(mask, compact=False):
+    """With `compact` labels are stored in the smallest unsigned dtype that holds them. Runs on one thread."""
+    # imops labels are consecutive, sizes are ordered by label
+    ccs, sizes = label(mask, return_sizes=True)
+    if compact:
+        ccs = ccs.astype(smallest_uint_dtype(len(sizes)), copy=False)
 
-                assign_size = result[i * half_block : (i + 2) * half_block, j * half_block : (j + 2) * half_block].shape
+    return ComponentTable(ccs, sizes)
 
-                block_lin_interp = block_lin_interp[: assign_size[0], : assign_size[1]]
 
-                result[i * half_block : (i + 2) * half_block, j * half_block : (j + 2) * half_block] = block_lin_interp
+def select_components(table, keep):
+    """Mask of the components with `keep` set, a lookup indexed by the label image."""
+    lookup = np.zeros(table.num_components + 1, dtype=bool)
+    lookup[1:] = keep
 
-    return result
+    return lookup[table.ccs]
@@ -0,0 +1,304 @@
+import math
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from .ops import FiberSegmentTable, Fitting
+
+
+# Default diameter histogram bins in pixels, scaled to the units of the measurements by the pixel spacing
+DIAMETER_BIN_WIDTH_PX = 0.5
+DIAMETER_NUM_BINS = 128
+
+
+def _finite_or_none(value):
+    """`None` for infinite and NaN values, which JSON can not represent."""
+    return value if math.isfinite(value) else None
+
+
+@dataclass
+class Moments:
+    """Count, mean, variance and range of a stream, updated and merged with the parallel Welford formulas."""
+
+    count: int = 0
+    mean: float = 0.0
+    m2: float = 0.0
+    min: float = math.inf
+    max: float = -math.inf
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values):
+            mean = values.mean()
+            self.merge(Moments(len(values), mean, ((values - mean) ** 2).sum(), values.min(), values.max()))
+
+        return self
+
+    def merge(self, other):
+        count = self.count + other.count
+        if count:
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / count
+            self.m2 += other.m2 + delta * delta * self.count * other.count / count
+            self.count = count
+            self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+
+        return self
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count else math.nan
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+    def to_dict(self):
+        return dict(
+            count=self.count, mean=self.mean, m2=self.m2, min=_finite_or_none(self.min), max=_finite_or_none(self.max)
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        minimum, maximum = data['min'], data['max']
+
+        return cls(
+            count=data['count'],
+            mean=data['mean'],
+            m2=data['m2'],
+            min=math.inf if minimum is None else minimum,
+            max=-math.inf if maximum is None else maximum,
+        )
+
+
+@dataclass
+class Histogram:
+    """Fixed bins of `bin_width` from `start`, values outside the bins are counted as underflow and overflow."""
+
+    start: float = 0.0
+    bin_width: float = 0.5
+    num_bins: int = 128
+    counts: np.ndarray = None
+    underflow: int = 0
+    overflow: int = 0
+
+    def __post_init__(self):
+        if self.counts is None:
+            self.counts = np.zeros(self.num_bins, dtype=np.int64)
+        self.counts = np.asarray(self.counts, dtype=np.int64)
+
+    @property
+    def edges(self):
+        return self.start + self.bin_width * np.arange(self.num_bins + 1)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        bins = np.floor((values - self.start) / self.bin_width)
+
+        self.underflow += int(np.sum(bins < 0))
+        self.overflow += int(np.sum(bins >= self.num_bins))
+        inside = (bins >= 0) & (bins < self.num_bins)
+        self.counts += np.bincount(bins[inside].astype(np.int64), minlength=self.num_bins)
+
+        return self
+
+    def merge(self, other):
+        if (self.start, self.bin_width, self.num_bins) != (other.start, other.bin_width, other.num_bins):
+            raise ValueError('Histograms with different bins cannot be merged')
+
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+
+        return self
+
+    def to_dict(self):
+        return dict(
+            start=self.start,
+            bin_width=self.bin_width,
+            num_bins=self.num_bins,
+            counts=self.counts.tolist(),
+            underflow=self.underflow,
+            overflow=self.overflow,
+        )
+
+
+@dataclass
+class QuantileSketch:
+    """
+    Quantiles of positive values with relative error `relative_accuracy`, from counts of logarithmic buckets.
+
+    Unlike t-digest centroids, bucket counts merge exactly: a merged sketch is the sketch of the pooled values,
+    in any merge order. Memory grows with the logarithm of the value range, not with the number of values.
+    Values up to `min_value` share one bucket.
+    """
+
+    relative_accuracy: float = 0.01
+    min_value: float = 1e-9
+    buckets: dict = field(default_factory=dict)
+    zero_count: int = 0
+
+    @property
+    def _gamma(self):
+        return (1 + self.relative_accuracy) / (1 - self.relative_accuracy)
+
+    @property
+    def count(self):
+        return self.zero_count + sum(self.buckets.values())
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        positive = values > self.min_value
+        self.zero_count += int(np.sum(~positive))
+
+        indices, counts = np.unique(np.ceil(np.log(values[positive]) / np.log(self._gamma)), return_counts=True)
+        for index, count in zip(indices.astype(int).tolist(), counts.tolist()):
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+        return self
+
+    def merge(self, other):
+        if (self.relative_accuracy, self.min_value) != (other.relative_accuracy, other.min_value):
+            raise ValueError('Sketches with different accuracy cannot be merged')
+
+        self.zero_count += other.zero_count
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+        return self
+
+    def quantile(self, q):
+        count = self.count
+        if count == 0:
+            return math.nan
+
+        rank = q * (count - 1)
+        if rank < self.zero_count:
+            return 0.0
+
+        cumulative = self.zero_count
+        for index in sorted(self.buckets):
+            cumulative += self.buckets[index]
+            if cumulative > rank:
+                # The value with the smallest relative error to every value of the bucket
+                return 2 * self._gamma**index / (self._gamma + 1)
+
+        return 2 * self._gamma ** max(self.buckets) / (self._gamma + 1)
+
+    def to_dict(self):
+        return dict(
+            relative_accuracy=self.relative_accuracy,
+            min_value=self.min_value,
+            buckets={str(index): count for index, count in sorted(self.buckets.items())},
+            zero_count=self.zero_count,
+        )
+
+
+@dataclass
+class FiberStatistics:
+    """
+    Pooled fiber statistics over any number of images, in constant memory.
+
+    `update` takes outputs of the pipeline for one image: a `FiberSegmentTable`, a `Fitting` whose lines
+    are counted, or an array of measured diameters. Statistics of separate workers are combined with `merge`,
+    counts, histograms and quantiles of the merged statistics equal those of a single pass over all images.
+    Diameter histogram bins are in the units of the measurements, see `for_pixel_spacing`.
+    """
+
+    diameter: Moments = field(default_factory=Moments)
+    diameter_histogram: Histogram = field(
+        default_factory=lambda: Histogram(0.0, DIAMETER_BIN_WIDTH_PX, DIAMETER_NUM_BINS)
+    )
+    diameter_quantiles: QuantileSketch = field(default_factory=QuantileSketch)
+    length: Moments = field(default_factory=Moments)
+    angle_histogram: Histogram = field(default_factory=lambda: Histogram(0.0, np.pi / 36, 36))
+    num_images: int = 0
+    num_lines: int = 0
+    num_fitted_lines: int = 0
+
+    @classmethod
+    def for_pixel_spacing(cls, pixel_spacing=1.0, diameter_bin_width=None, diameter_num_bins=DIAMETER_NUM_BINS):
+        """
+        Empty statistics of measurements in units of `pixel_spacing`, with diameter bins of `diameter_bin_width`
+        in the same units, by default `DIAMETER_BIN_WIDTH_PX` pixels.
+        """
+        if diameter_bin_width is None:
+            diameter_bin_width = DIAMETER_BIN_WIDTH_PX * pixel_spacing
+
+        return cls(diameter_histogram=Histogram(0.0, diameter_bin_width, diameter_num_bins))
+
+    def update(self, *outputs):
+        """Add the outputs of one image."""
+        self.num_images += 1
+
+        for value in outputs:
+            match value:
+                case FiberSegmentTable():
+                    self._update_diameters(value.diameter)
+                    self.length.update(value.length)
+                    self.angle_histogram.update(value.angle)
+                case Fitting():
+                    self.num_fitted_lines += int(np.count_nonzero(value.fitting_blocked_params[..., 3]))
+                case _:
+                    self._update_diameters(value)
+
+        return self
+
+    def _update_diameters(self, diameters):
+        self.diameter.update(diameters)
+        self.diameter_histogram.update(diameters)
+        self.diameter_quantiles.update(diameters)
+        self.num_lines += len(np.ravel(diameters))
+
+    def merge(self, other):
+        self.diameter.merge(other.diameter)
+        self.diameter_histogram.merge(other.diameter_histogram)
+        self.diameter_quantiles.merge(other.diameter_quantiles)
+        self.length.merge(other.length)
+        self.angle_histogram.merge(other.angle_histogram)
+        self.num_images += other.num_images
+        self.num_lines += other.num_lines
+        self.num_fitted_lines += other.num_fitted_lines
+
+        return self
+
+    def summary(self, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        """Counts and diameter statistics, `None` where there are no diameters."""
+        return dict(
+            num_images=self.num_images,
+            num_lines=self.num_lines,
+            num_fitted_lines=self.num_fitted_lines,
+            diameter_mean=self.diameter.mean if self.diameter.count else None,
+            diameter_std=_finite_or_none(self.diameter.std),
+            diameter_min=_finite_or_none(self.diameter.min),
+            diameter_max=_finite_or_none(self.diameter.max),
+            diameter_quantiles={q: _finite_or_none(self.diameter_quantiles.quantile(q)) for q in quantiles},
+        )
+
+    def to_dict(self):
+        return dict(
+            diameter=self.diameter.to_dict(),
+            diameter_histogram=self.diameter_histogram.to_dict(),
+            diameter_quantiles=self.diameter_quantiles.to_dict(),
+            length=self.length.to_dict(),
+            angle_histogram=self.angle_histogram.to_dict(),
+            num_images=self.num_images,
+            num_lines=self.num_lines,
+            num_fitted_lines=self.num_fitted_lines,
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        quantiles = dict(data['diameter_quantiles'])
+        quantiles['buckets'] = {int(index): count for index, count in quantiles['buckets'].items()}
+
+        return cls(
+            diameter=Moments.from_dict(data['diameter']),
+            diameter_histogram=Histogram(**data['diameter_histogram']),
+            diameter_quantiles=QuantileSketch(**quantiles),
+            length=Moments.from_dict(data['length']),
+            angle_histogram=Histogram(**data['angle_histogram']),
+            num_images=data['num_images'],
+            num_lines=data['num_lines'],
+            num_fitted_lines=data['num_fitted_lines'],
+        )
@@ -0,0 +1,205 @@
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+from imops import label
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from .ops import Fitting, block_grid_shape, visualize_fitting
+from .transforms import (
+    Binarize,
+    CCSFilter,
+    FiberThickness,
+    LineFittingTLS,
+    Opening,
+    RichardsonLucyDeconv,
+    SkeletonizeEDT,
+)
+
+
+def _tiles(shape, tile_size):
+    H, W = shape
+
+    for y0 in range(0, H, tile_size):
+        for x0 in range(0, W, tile_size):
+            yield slice(y0, min(y0 + tile_size, H)), slice(x0, min(x0 + tile_size, W))
+
+
+def _with_halo(tile, shape, halo):
+    """Tile extended by `halo` pixels clipped to the image, and the tile position inside the extended one."""
+    (rows, cols), (H, W) = tile, shape
+    y0, x0 = max(rows.start - halo, 0), max(cols.start - halo, 0)
+    y1, x1 = min(rows.stop + halo, H), min(cols.stop + halo, W)
+
+    inner = (slice(rows.start - y0, rows.stop - y0), slice(cols.start - x0, cols.stop - x0))
+
+    return (slice(y0, y1), slice(x0, x1)), inner
+
+
+class TiledExecutor:
+    """
+    Out-of-core execution of a transform chain for images that do not fit into memory.
+
+    Every step is applied tile by tile: local steps read tiles extended by the footprint of the
+    operation (`_halo` of the transform), connected-component filters label tiles and merge labels
+    across tile borders before filtering by global component sizes, and line fitting works on tiles
+    aligned with the block grid. Full-size results are stored in memory-mapped scratch files,
+    so peak memory depends on `tile_size` rather than on the image size.
+
+    Outputs that index the whole image at once, like `SkeletonizeEDT.skeleton_index` and the component tables,
+    are not produced.
+    """
+
+    def __init__(self, tile_size=2048, scratch_dir=None):
+        self.tile_size = tile_size
+        self._scratch = tempfile.TemporaryDirectory(dir=scratch_dir, prefix='fibmeasure-tiles-')
+        self._counter = 0
+        self.timings = {}
+
+    @property
+    def scratch_dir(self):
+        return Path(self._scratch.name)
+
+    def cleanup(self):
+        self._scratch.cleanup()
+
+    def _allocate(self, shape, dtype):
+        self._counter += 1
+
+        return np.lib.format.open_memmap(self.scratch_dir / f'{self._counter}.npy', mode='w+', dtype=dtype, shape=shape)
+
+    def __call__(self, transforms, image):
+        node = {'image': image}
+
+        for transform in transforms:
+            # TransformView wraps the transform itself
+            transform = getattr(transform, '_transform', transform)
+            start = perf_counter()
+
+            match transform:
+                case RichardsonLucyDeconv() | Binarize() | Opening():
+                    outputs = self._run_local(transform, node)
+                case CCSFilter():
+                    outputs = {'bin_image': self._filter_components(transform, node['bin_image'], halo=0, local=None)}
+                case SkeletonizeEDT():
+                    outputs = {
+                        'skeleton': self._filter_components(
+                            transform, node['bin_image'], halo=transform._halo(), local=transform._axial_points
+                        )
+                    }
+                case LineFittingTLS():
+                    outputs = self._run_line_fitting(transform, node)
+                case FiberThickness():
+                    outputs = self._run_fiber_thickness(transform, node)
+                case _:
+                    raise TypeError(f'{transform.__class__.__name__} has no tiled implementation')
+
+            self.timings[transform.__class__.__name__] = perf_counter() - start
+            node = {**node, **outputs}
+
+        return node
+
+    def _run_local(self, transform, node):
+        shape, halo = node['image'].shape, transform._halo()
+        names = {p for spec in transform._name2transform_spec.values() for p in spec.params if p != 'self'}
+        outputs = {}
+
+        for tile in _tiles(shape, self.tile_size):
+            outer, inner = _with_halo(tile, shape, halo)
+            tile_outputs = transform({name: np.asarray(node[name][outer]) for name in names})
+
+            for name in transform._transform_order:
+                if name not in outputs:
+                    outputs[name] = self._allocate(shape, tile_outputs[name].dtype)
+                outputs[name][tile] = tile_outputs[name][inner]
+
+        return outputs
+
+    def _filter_components(self, transform, mask, halo, local):
+        shape = mask.shape
+        labels = self._allocate(shape, np.int64)
+        sizes, offset = [np.zeros(1, dtype=np.int64)], 0
+
+        # Label every tile with globally unique labels
+        for tile in _tiles(shape, self.tile_size):
+            outer, inner = _with_halo(tile, shape, halo)
+            tile_mask = np.asarray(mask[outer])
+            if local is not None:
+                tile_mask = local(tile_mask)
+
+            tile_labels, num = label(tile_mask[inner], return_num=True)
+            tile_labels = tile_labels.astype(np.int64)
+            sizes.append(np.bincount(tile_labels.ravel(), minlength=num + 1)[1:])
+            labels[tile] = np.where(tile_labels > 0, tile_labels + offset, 0)
+            offset += num
+
+        # Merge labels touching across tile borders, 8-connectivity
+        pairs = []
+        for axis, size in enumerate(shape):
+            for border in range(self.tile_size, size, self.tile_size):
+                before = np.asarray(labels[border - 1] if axis == 0 else labels[:, border - 1])
+                after = np.asarray(labels[border] if axis == 0 else labels[:, border])
+
+                for shift in (-1, 0, 1):
+                    a = before[max(shift, 0) : len(before) + min(shift, 0)]
+                    b = after[max(-shift, 0) : len(after) + min(-shift, 0)]
+                    touching = (a > 0) & (b > 0)
+                    pairs.append(np.stack([a[touching], b[touching]]))
+
+        pairs = np.concatenate(pairs, axis=1) if pairs else np.zeros((2, 0), dtype=np.int64)
+        graph = coo_matrix((np.ones(pairs.shape[1]), (pairs[0], pairs[1])), shape=(offset + 1, offset + 1))
+        _, roots = connected_components(graph, directed=False)
+
+        component_sizes = np.bincount(roots, weights=np.concatenate(sizes), minlength=roots.max() + 1)
+        keep = transform._keep_sizes(component_sizes, np.prod(shape))[roots]
+        keep[0] = False
+
+        output = self._allocate(shape, bool)
+        for tile in _tiles(shape, self.tile_size):
+            output[tile] = keep[labels[tile]]
+
+        return output
+
+    def _run_line_fitting(self, transform, node):
+        skeleton, bin_image = node['skeleton'], node['bin_image']
+        (H, W), half_block = skeleton.shape, transform.block // 2
+        # Tiles are aligned with the block grid and extended by half a block to hold their last blocks
+        tile_size = max(half_block, self.tile_size // half_block * half_block)
+
+        params = np.zeros((*block_grid_shape((H, W), transform.block), 4), dtype=np.float32)
+        for rows, cols in _tiles((H, W), tile_size):
+            outer = slice(rows.start, min(rows.stop + half_block, H)), slice(cols.start, min(cols.stop + half_block, W))
+            fitting = transform.fitting_results(np.asarray(skeleton[outer]), np.asarray(bin_image[outer]), None)
+
+            i0, j0 = rows.start // half_block, cols.start // half_block
+            i1 = params.shape[0] if rows.stop == H else rows.stop // half_block
+            j1 = params.shape[1] if cols.stop == W else cols.stop // half_block
+            params[i0:i1, j0:j1] = fitting.fitting_blocked_params[: i1 - i0, : j1 - j0]
+
+        fitting_results = Fitting((H, W), transform.block, params)
+
+        image_lined = self._allocate((H, W), bool)
+        for tile in _tiles((H, W), self.tile_size):
+            image_lined[tile] = visualize_fitting(fitting_results, roi=tile)
+
+        return {'fitting_results': fitting_results, 'image_lined': image_lined}
+
+    def _run_fiber_thickness(self, transform, node):
+        bin_image = node['bin_image']
+        shape, halo = bin_image.shape, transform._halo()
+
+        distance = None
+        for tile in _tiles(shape, self.tile_size):
+            outer, inner = _with_halo(tile, shape, halo)
+            tile_distance = transform.distance(np.asarray(bin_image[outer]))
+
+            if distance is None:
+                distance = self._allocate(shape, tile_distance.dtype)
+            distance[tile] = tile_distance[inner]
+
+        return {
+            'distance': distance,
+            'fiber_segments': transform.fiber_segments(node['fitting_results'], distance),
+        }
@@ -1,20 +1,113 @@
-from .vtransforms import VRichardsonLucyDeconv, VBinarize, VOpening, VCCSFilter, VSkeletonizeEDT, VLineFittingTLS
+import copy
+import hashlib
+from dataclasses import dataclass
+from typing import Any
 
+import numpy as np
+
+from ..__version__ import __version__
+from .background import Cancelled
+from .cache import LRUCache, PackedMask, nbytes
+from .transforms import DEFAULT_EXECUTION, DEFAULT_PRECISION
+from .utils import array_digest, downscale_mean, spill_to_memmap, temporary_memmap
+from .vtransforms import (
+    VRichardsonLucyDeconv,
+    VBinarize,
+    VOpening,
+    VCCSFilter,
+    VSkeletonizeEDT,
+    VLineFittingTLS,
+    VFiberThickness,
+)
+
+
+DEFAULT_CACHE_BYTES = 2 * 1024**3
+DEFAULT_DISK_CACHE_BYTES = 16 * 1024**3
+# Smaller outputs are not worth a scratch file
+SPILL_MIN_BYTES = 2**20
+# Previews are computed on the source downscaled by a power of two to at most this many pixels
+PREVIEW_PIXELS = 2**20
+PREVIEW_CACHE_BYTES = 256 * 1024**2
+# Entry of every step in the disk cache also holds the description it was stored under, to validate it on load
+DISK_DESCRIPTION_NAME = '__description__'
+
+
+def default_transforms():
+    return [
+        VRichardsonLucyDeconv(),
+        VBinarize(),
+        VOpening(),
+        VCCSFilter(),
+        VSkeletonizeEDT(),
+        VLineFittingTLS(),
+        VFiberThickness(),
+    ]
+
+
+@dataclass
+class _Computation:
+    node_key: tuple
+    input_node: dict[str, Any]
+    params: dict[str, Any]
+    result_node: dict[str, Any]
 
-class TransformHandler:
-    transforms = [VRichardsonLucyDeconv(), VBinarize(), VOpening(), VCCSFilter(), VSkeletonizeEDT(), VLineFittingTLS()]
 
-    def __init__(self, source_image):
+class TransformHandler:
+    def __init__(
+        self,
+        source_image,
+        cache_bytes=DEFAULT_CACHE_BYTES,
+        transforms=None,
+        spill=False,
+        scratch_dir=None,
+        precision=DEFAULT_PRECISION,
+        execution=DEFAULT_EXECUTION,
+        pixel_spacing=1.0,
+        preview_pixels=PREVIEW_PIXELS,
+        disk_cache=None,
+    ):
+        """
+        With `spill` array outputs of every step are moved to memory-mapped temporary files in `scratch_dir`,
+        cached nodes then live in the page cache instead of process memory, `cache_bytes` bounds the scratch size.
+        Nodes of the last computation of every step are always held and count against `cache_bytes`,
+        the cache keeps other nodes within what they leave of it. Nodes are held in their compact form,
+        e.g. with packed masks, and restored for transforms and callers on demand.
+        `precision` is applied to every transform and to the cached outputs, `execution` sets the number
+        of threads of every transform. Measurements are reported in units of `pixel_spacing`.
+        Sources larger than `preview_pixels` get previews, see `get_preview_before_after_images`.
+        Outputs are also looked up in and stored to `disk_cache`, a `DiskCache` shared between runs,
+        by the digest of the source and the parameters of the step and every step before it.
+        """
         self.source_image = source_image
         self.current_transform_idx = 0
+        self.spill = spill
+        self.scratch_dir = scratch_dir
+        self.precision = precision
+        self.execution = execution
+        self.pixel_spacing = pixel_spacing
+        self.preview_pixels = preview_pixels
+        self.disk_cache = disk_cache
+        self._source_digest = None
 
-        self.transform_result_nodes = {idx: None for idx in range(len(self.transforms))}
+        self.cache_bytes = cache_bytes
 
-    def update_param(self, name, value):
-        # Cached node results invalidation
-        for idx in range(self.current_transform_idx, len(self.transforms)):
-            self.transform_result_nodes[idx] = None
+        self.transforms = default_transforms() if transforms is None else transforms
+        for transform in self.transforms:
+            transform.set_precision(precision)
+            transform.set_execution(execution)
+            transform.set_pixel_spacing(pixel_spacing)
 
+        # Outputs of every step keyed by parameter values of the step and every step before it
+        self.transform_result_nodes = LRUCache(cache_bytes)
+        # Last computation of every step, the nodes of the current parameters and the base for partial recompute
+        self._last_computations = {}
+        # Unpacked result images of the current before and after steps, held so that the display keeps their pyramids
+        self._result_images = {}
+        self._preview = None
+        # Copied before anything is computed, so that the copies do not carry state of full-resolution runs
+        self._preview_transforms = [copy.deepcopy(transform) for transform in self.transforms]
+
+    def update_param(self, name, value):
         self.transforms[self.current_transform_idx].set_current_value(name, value)
 
     @property
@@ -39,30 +132,231 @@ class TransformHandler:
         self.current_transform_idx -= 1
         return True
 
-    def get_result_node(self, transform_idx):
+    def get_node_key(self, transform_idx):
+        return tuple(tuple(transform.get_params().items()) for transform in self.transforms[: transform_idx + 1])
+
+    def is_computed(self, transform_idx):
+        """Whether results of the step and every step before it for the current parameters are at hand."""
+        for idx in range(transform_idx + 1):
+            last = self._last_computations.get(idx)
+            node_key = self.get_node_key(idx)
+            if last is not None and last.node_key == node_key or node_key in self.transform_result_nodes:
+                continue
+
+            if self.disk_cache is None or self._disk_key(idx) not in self.disk_cache:
+                return False
+
+        return True
+
+    def get_result_node(self, transform_idx, cancelled=None):
+        """
+        Node of the step with restored values, unpacked masks are not held by the handler.
+        Before computing every step `cancelled()` is checked, `Cancelled` is raised once it is true.
+        """
+        result_node = self._get_compact_node(transform_idx, cancelled)
+
+        return {name: self._restore(value) for name, value in result_node.items()}
+
+    def _get_compact_node(self, transform_idx, cancelled=None):
         if transform_idx == -1:
-            result_node = {'image': self.source_image}
-        else:
-            result_node = self.transform_result_nodes[transform_idx]
+            return {'image': self.source_image}
+
+        node_key = self.get_node_key(transform_idx)
+        last = self._last_computations.get(transform_idx)
+        if last is not None and last.node_key == node_key:
+            return last.result_node
+
+        prev_result_node = self._get_compact_node(transform_idx - 1, cancelled)
+        if cancelled is not None and cancelled():
+            raise Cancelled
+
+        transform = self.transforms[transform_idx]
+        params = transform.get_params()
 
-        if result_node is None:
-            prev_result_node = self.get_result_node(transform_idx - 1)
-            result_node = self.transforms[transform_idx](prev_result_node)
-            self.transform_result_nodes[transform_idx] = result_node
+        outputs = self.transform_result_nodes.get(node_key)
+        if outputs is None and self.disk_cache is not None:
+            description = self._disk_description(transform_idx)
+            disk_key = self._disk_key(transform_idx, description)
+            outputs = self.disk_cache.get(disk_key)
+            # An incomplete entry would let outputs of the previous step stand in for the missing ones
+            if outputs is not None and (
+                outputs.pop(DISK_DESCRIPTION_NAME, None) != description
+                or not set(transform.output_names) <= outputs.keys()
+            ):
+                self.disk_cache.remove(disk_key)
+                outputs = None
+            if outputs is not None:
+                self.transform_result_nodes.put(node_key, outputs)
+
+        if outputs is None:
+            inputs = {
+                name: self._restore(prev_result_node[name]) for name in transform.input_names & prev_result_node.keys()
+            }
+            result_node = transform(inputs, self._reusable_outputs(transform_idx, prev_result_node, params))
+            outputs = {name: self._compact(result_node[name]) for name in transform.output_names}
+
+            # Only own outputs are cached, inputs passed through are cached by the nodes that produced them
+            self.transform_result_nodes.put(node_key, outputs)
+            if self.disk_cache is not None:
+                description = self._disk_description(transform_idx)
+                self.disk_cache.put(
+                    self._disk_key(transform_idx, description), {**outputs, DISK_DESCRIPTION_NAME: description}
+                )
+
+        result_node = {**outputs, **{k: v for k, v in prev_result_node.items() if k not in outputs}}
+        self._last_computations[transform_idx] = _Computation(node_key, prev_result_node, params, result_node)
+        # The cache gets what the last computations leave of the budget
+        self.transform_result_nodes.resize(max(0, self.cache_bytes - self.pinned_bytes))
 
         return result_node
 
-    def get_result_image(self, transform_idx):
+    @property
+    def pinned_bytes(self):
+        """
+        Bytes of outputs held by the last computations and not by the cache, e.g. evicted from it,
+        and of the unpacked result images.
+        """
+        cached = {id(value) for outputs in self.transform_result_nodes.values() for value in outputs.values()}
+        pinned = {}
+
+        for idx, last in self._last_computations.items():
+            for name in self.transforms[idx].output_names:
+                value = last.result_node[name]
+                if id(value) not in cached:
+                    pinned[id(value)] = nbytes(value)
+
+        for _, image in self._result_images.values():
+            pinned[id(image)] = nbytes(image)
+
+        return sum(pinned.values())
+
+    @property
+    def nbytes(self):
+        """Bytes of all outputs the handler holds, cached and pinned by the last computations."""
+        return self.transform_result_nodes.nbytes + self.pinned_bytes
+
+    def _disk_description(self, transform_idx):
+        """
+        Everything the outputs of the step depend on: the source, the precision, the pixel spacing and the state
+        of the step and every step before it, not only the slider parameters.
+        """
+        if self._source_digest is None:
+            self._source_digest = array_digest(self.source_image)
+
+        steps = [
+            (transform.transform_name, sorted(transform.get_state().items()))
+            for transform in self.transforms[: transform_idx + 1]
+        ]
+
+        return repr((__version__, self._source_digest, self.precision, self.pixel_spacing, steps))
+
+    def _disk_key(self, transform_idx, description=None):
+        description = self._disk_description(transform_idx) if description is None else description
+
+        return hashlib.blake2b(description.encode('utf-8'), digest_size=16).hexdigest()
+
+    def _compact(self, value):
+        if not isinstance(value, np.ndarray):
+            return value
+
+        if value.dtype == bool and self.precision.pack_masks:
+            packed = PackedMask.pack(value)
+            if self.spill and packed.nbytes >= SPILL_MIN_BYTES:
+                packed = PackedMask(spill_to_memmap(packed.bits, self.scratch_dir), packed.shape)
+
+            return packed
+
+        if np.issubdtype(value.dtype, np.floating) and value.dtype != self.precision.float_dtype:
+            value = value.astype(self.precision.float_dtype)
+
+        if self.spill and not isinstance(value, np.memmap) and value.nbytes >= SPILL_MIN_BYTES:
+            value = spill_to_memmap(value, self.scratch_dir)
+
+        return value
+
+    def _restore(self, value):
+        if not isinstance(value, PackedMask):
+            return value
+
+        # Unpacked masks of the current nodes are spilled as well, otherwise they would stay in process memory
+        if self.spill and value.nbytes * 8 >= SPILL_MIN_BYTES:
+            return value.unpack(out=temporary_memmap(value.shape, bool, self.scratch_dir))
+
+        return value.unpack()
+
+    def _reusable_outputs(self, transform_idx, input_node, params):
+        if transform_idx not in self._last_computations:
+            return None
+
+        last = self._last_computations[transform_idx]
+        changed_params = [name for name, value in params.items() if last.params[name] != value]
+        # Compact values of a node are the same objects as long as they are valid
+        changed_inputs = [
+            name for name in input_node.keys() | last.input_node.keys()
+            if input_node.get(name) is not last.input_node.get(name)
+        ]
+        transform = self.transforms[transform_idx]
+        stale = transform.stale_outputs(changed_params, changed_inputs)
+
+        return {name: self._restore(last.result_node[name]) for name in transform.output_names if name not in stale}
+
+    def get_result_image(self, transform_idx, cancelled=None):
         if transform_idx == -1:
             return self.source_image
 
-        result_node = self.get_result_node(transform_idx)
-        visualization_key = self.transforms[transform_idx].visualization_key
+        value = self._get_compact_node(transform_idx, cancelled)[self.transforms[transform_idx].visualization_key]
+        if not isinstance(value, PackedMask):
+            return value
+
+        held = self._result_images.get(transform_idx)
+        # The same array for the same result, so that the display reuses what it has built for it
+        if held is None or held[0] is not value:
+            held = (value, self._restore(value))
+            self._result_images[transform_idx] = held
+
+        return held[1]
+
+    def get_before_after_images(self, cancelled=None):
+        shown = (self.current_transform_idx - 1, self.current_transform_idx)
+        self._result_images = {idx: held for idx, held in self._result_images.items() if idx in shown}
+
+        return tuple(self.get_result_image(idx, cancelled) for idx in shown)
+
+    @property
+    def preview_factor(self):
+        """How many times the preview source is smaller than the source, 1 if there are no previews."""
+        factor = 1
+        while self.source_image.size > self.preview_pixels * factor**2:
+            factor *= 2
+
+        return factor
+
+    def get_preview_before_after_images(self, cancelled=None):
+        """
+        Images of the current step computed on the downscaled source with parameters in pixels scaled to match,
+        a fast approximation of `get_before_after_images`.
+        """
+        factor = self.preview_factor
+        if factor == 1:
+            return self.get_before_after_images(cancelled)
+
+        if self._preview is None:
+            self._preview = TransformHandler(
+                downscale_mean(self.source_image, factor),
+                cache_bytes=PREVIEW_CACHE_BYTES,
+                transforms=self._preview_transforms,
+                precision=self.precision,
+                execution=self.execution,
+                pixel_spacing=self.pixel_spacing * factor,
+                preview_pixels=self.source_image.size,
+            )
 
-        return result_node[visualization_key]
+        for transform, preview_transform in zip(self.transforms, self._preview.transforms):
+            for name, value in transform.get_scaled_params(1 / factor).items():
+                preview_transform.set_current_value(name, value)
+        self._preview.current_transform_idx = self.current_transform_idx
 
-    def get_before_after_images(self):
-        return self.get_result_image(self.current_transform_idx - 1), self.get_result_image(self.current_transform_idx)
+        return self._preview.get_before_after_images(cancelled)
 
     def get_sliders(self):
         return self.transforms[self.current_transform_idx].get_sliders()
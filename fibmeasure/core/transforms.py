@@ -1,24 +1,259 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
 import numpy as np
-from imops import binary_dilation, binary_opening, label
 from imops.morphology import distance_transform_edt
-from skimage.feature import peak_local_max
-from skimage.morphology import disk
-from skimage.restoration import richardson_lucy
+from scipy import ndimage
+from scipy.fft import irfft2, next_fast_len, rfft2
 
 from .base import Transform, Output
-from .ops import blocked_line_fitting_tls, visualize_fitting
+from .morphology import disk_dilation, disk_opening
+from .ops import (
+    FiberSegmentTable,
+    MomentIndex,
+    blocked_line_fitting_tls,
+    component_table,
+    measure_fibers,
+    select_components,
+    visualize_fitting,
+)
+from .utils import available_cpus
+
+
+@dataclass(frozen=True)
+class PrecisionPolicy:
+    """
+    Floating dtype used by the transforms and their cached results, whether cached masks are bit-packed
+    and whether moment index tables and component labels use the smallest dtype that holds them.
+    """
+
+    float_dtype: type = np.float32
+    pack_masks: bool = True
+    compact_indices: bool = True
+
+
+DEFAULT_PRECISION = PrecisionPolicy()
+FLOAT64_PRECISION = PrecisionPolicy(np.float64, pack_masks=False, compact_indices=False)
+
+
+@dataclass(frozen=True)
+class ExecutionContext:
+    """
+    Number of threads every transform may use, by default all CPUs available to the process.
+    Connected component labeling always runs on one thread, `imops.label` has no parallel implementation.
+    """
+
+    num_threads: int | None = None
+
+    @property
+    def threads(self):
+        return available_cpus() if self.num_threads is None else self.num_threads
+
+
+DEFAULT_EXECUTION = ExecutionContext()
+
+
+# PSFs at least this wide are convolved through FFT, smaller ones directly
+FFT_MIN_PSF_SIZE = 5
+# Convolutions are split into row bands between threads only for images at least this tall
+MIN_ROWS_PER_THREAD = 256
+# Relative size of the second singular value up to which a PSF is treated as separable
+SEPARABLE_RTOL = 1e-6
+# Largest fiber radius in pixels for which the distance transform of a tile is exact, see `core.tiling`
+EDT_HALO = 64
+
+
+def _in_row_bands(convolve, shape, halo, workers):
+    """Run `convolve` on row bands extended by `halo` rows, the bands run on `workers` threads."""
+    num_bands = max(1, min(workers, shape[0] // MIN_ROWS_PER_THREAD))
+    if num_bands == 1:
+        return convolve
+
+    bounds = np.linspace(0, shape[0], num_bands + 1).astype(int)
+
+    def banded(x):
+        output = np.empty_like(x)
+
+        def convolve_band(y0, y1):
+            e0, e1 = max(y0 - halo, 0), min(y1 + halo, shape[0])
+            output[y0:y1] = convolve(x[e0:e1])[y0 - e0 : y1 - e0]
+
+        with ThreadPoolExecutor(num_bands) as executor:
+            list(executor.map(convolve_band, bounds[:-1], bounds[1:]))
+
+        return output
+
+    return banded
+
+
+def _separable_factors(psf):
+    """Column and row kernels whose outer product is `psf`, None if it is not separable."""
+    u, s, vt = np.linalg.svd(psf.astype(np.float64))
+    if len(s) > 1 and s[1] > SEPARABLE_RTOL * s[0]:
+        return None
+
+    scale = np.sqrt(s[0])
+    # The sign of singular vectors is arbitrary
+    sign = -1 if u[np.abs(u[:, 0]).argmax(), 0] < 0 else 1
+
+    return (sign * scale * u[:, 0]).astype(psf.dtype), (sign * scale * vt[0]).astype(psf.dtype)
+
+
+# All convolutions below are in the `same` mode of `scipy.signal.convolve`, origins match its centering for even sizes
+
+
+def _running_sum_rows(x, size):
+    """Sums over `size` consecutive rows, updating a float64 row accumulator once per row."""
+    height, center = len(x), (size - 1) // 2
+    output = np.empty_like(x)
+    window = x[:center].sum(axis=0, dtype=np.float64)
+
+    for i in range(height):
+        if i + center < height:
+            window += x[i + center]
+        if i + center >= size:
+            window -= x[i + center - size]
+        output[i] = window
+
+    return output
+
+
+def _box_convolution(shape, psf, workers):
+    """Uniform PSF, running sums along both axes, O(1) per pixel for any PSF size."""
+    (height, width), weight = psf.shape, psf.flat[0] * psf.shape[1]
+
+    def convolve(x):
+        # Running sums over rows, `uniform_filter1d` is a running mean and only fast along the contiguous axis
+        output = ndimage.uniform_filter1d(_running_sum_rows(x, height), width, axis=1, mode='constant')
+        output *= weight
+
+        return output
+
+    return _in_row_bands(convolve, shape, height, workers)
+
+
+def _separable_convolution(shape, psf, workers):
+    """Rank one PSF, two one-dimensional convolutions."""
+    column, row = _separable_factors(psf)
+    origin = [(size - 1) // 2 - size // 2 for size in psf.shape]
+
+    def convolve(x):
+        output = ndimage.convolve1d(x, column, axis=0, mode='constant', origin=origin[0])
+        return ndimage.convolve1d(output, row, axis=1, mode='constant', origin=origin[1])
+
+    return _in_row_bands(convolve, shape, len(column), workers)
+
+
+def _direct_convolution(shape, psf, workers):
+    origin = [(size - 1) // 2 - size // 2 for size in psf.shape]
+
+    def convolve(x):
+        return ndimage.convolve(x, psf, mode='constant', origin=origin)
+
+    return _in_row_bands(convolve, shape, psf.shape[0], workers)
+
+
+def _fft_convolution(shape, psf, workers):
+    """The PSF transform is computed once, FFTs run on `workers` threads."""
+    fshape = [next_fast_len(size + psf_size - 1, real=True) for size, psf_size in zip(shape, psf.shape)]
+    crop = tuple(slice((psf_size - 1) // 2, (psf_size - 1) // 2 + size) for size, psf_size in zip(shape, psf.shape))
+    psf_fft = rfft2(psf, fshape, workers=workers)
+
+    def convolve(x):
+        return irfft2(rfft2(x, fshape, workers=workers) * psf_fft, fshape, workers=workers)[crop]
+
+    return convolve
+
+
+class RichardsonLucyEngine:
+    """
+    Richardson-Lucy deconvolution, same as `skimage.restoration.richardson_lucy` with clipping.
+
+    With `separable` uniform PSFs are convolved by running sums and other rank one PSFs by two one-dimensional
+    convolutions. Otherwise PSFs narrower than `fft_min_psf_size` are convolved directly, wider ones through FFT.
+    Convolutions with the PSF and the flipped PSF are prepared once per image shape and PSF and run on
+    `workers` threads. The unclipped estimate of the last call is kept, a call with the same image and PSF and
+    more iterations continues from it.
+    """
+
+    eps = 1e-12
+
+    def __init__(self, workers=None, fft_min_psf_size=FFT_MIN_PSF_SIZE, separable=True):
+        self.workers = workers
+        self.fft_min_psf_size = fft_min_psf_size
+        self.separable = separable
+        self._convolutions = None
+        self._state = None
+
+    def _make_convolution(self, shape, psf, workers):
+        if self.separable and np.all(psf == psf.flat[0]):
+            return _box_convolution(shape, psf, workers)
+        if self.separable and _separable_factors(psf) is not None:
+            return _separable_convolution(shape, psf, workers)
+        if max(psf.shape) >= self.fft_min_psf_size:
+            return _fft_convolution(shape, psf, workers)
+
+        return _direct_convolution(shape, psf, workers)
+
+    def _prepare(self, shape, psf):
+        key = (shape, psf.shape, psf.dtype, psf.tobytes(), self.separable, self.workers)
+        if self._convolutions is None or self._convolutions[0] != key:
+            workers = available_cpus() if self.workers is None else self.workers
+            self._convolutions = (
+                key,
+                self._make_convolution(shape, psf, workers),
+                self._make_convolution(shape, np.flip(psf), workers),
+            )
+
+        return self._convolutions[1:]
+
+    def __call__(self, image, psf, num_iter):
+        """Deconvolve `image` cast to the dtype of `psf`."""
+        convolve, convolve_flipped = self._prepare(image.shape, psf)
+        observed = image.astype(psf.dtype, copy=False)
+
+        state, self._state = self._state, None
+        if (
+            state is not None
+            and state[0] is image
+            and state[1].dtype == psf.dtype
+            and np.array_equal(state[1], psf)
+            and state[2] <= num_iter
+        ):
+            estimate, done = state[3], state[2]
+        else:
+            estimate, done = np.full(image.shape, 0.5, dtype=psf.dtype), 0
+
+        for _ in range(num_iter - done):
+            relative_blur = observed / (convolve(estimate) + self.eps)
+            estimate *= convolve_flipped(relative_blur)
+
+        self._state = image, psf, num_iter, estimate
+
+        return np.clip(estimate, -1, 1)
 
 
 class RichardsonLucyDeconv(Transform):
+    precision = DEFAULT_PRECISION
+    execution = DEFAULT_EXECUTION
+
     def __init__(self, psf_size=4, num_iter=4):
         self.psf_size = psf_size
         self.num_iter = num_iter
+        self._engine = RichardsonLucyEngine()
 
     def image(self, image):
-        psf = np.ones((self.psf_size, self.psf_size))
+        float_dtype = self.precision.float_dtype
+        psf = np.ones((self.psf_size, self.psf_size), dtype=float_dtype)
         psf /= psf.size
 
-        return richardson_lucy(image, psf, num_iter=self.num_iter)
+        self._engine.workers = self.execution.threads
+
+        return self._engine(image, psf, self.num_iter)
+
+    def _halo(self):
+        # Every iteration convolves twice, each convolution spreads by the PSF radius
+        return 2 * self.num_iter * self.psf_size
 
 
 class Binarize(Transform):
@@ -28,47 +263,83 @@ class Binarize(Transform):
     def bin_image(self, image):
         return image >= self.threshold
 
+    def _halo(self):
+        return 0
+
 
 class Opening(Transform):
+    execution = DEFAULT_EXECUTION
+
     def __init__(self, radius=5):
         self.radius = radius
 
     def bin_image(self, bin_image):
-        return binary_opening(bin_image, disk(self.radius), num_threads=16)
+        return disk_opening(bin_image, self.radius, num_threads=self.execution.threads)
+
+    def _halo(self):
+        return 2 * self.radius + 1
 
 
 class CCSFilter(Transform):
+    precision = DEFAULT_PRECISION
+
     def __init__(self, min_ratio=1e-3):
         self.min_ratio = min_ratio
 
-    def bin_image(self, bin_image):
-        ccs, labels, sizes = label(bin_image, return_labels=True, return_sizes=True)
-        ratios = sizes / np.prod(bin_image.shape)
+    def components(self, bin_image):
+        return component_table(bin_image, compact=self.precision.compact_indices)
 
-        return np.isin(ccs, labels[ratios >= self.min_ratio])
+    def bin_image(self, components: Output):
+        return select_components(components, self._keep_sizes(components.sizes, components.ccs.size))
+
+    def _keep_sizes(self, sizes, image_size):
+        return sizes / image_size >= self.min_ratio
 
 
 class SkeletonizeEDT(Transform):
+    precision = DEFAULT_PRECISION
+    execution = DEFAULT_EXECUTION
+
     def __init__(self, threshold_abs=5, dilation_radius=0, min_size=10):
         self.threshold_abs = threshold_abs
         self.dilation_radius = dilation_radius
         self.min_size = min_size
 
-    def skeleton(self, bin_image):
-        dist = distance_transform_edt(bin_image)
-        peaks = peak_local_max(dist, min_distance=1, threshold_abs=self.threshold_abs, labels=bin_image)
+    def skeleton_components(self, bin_image):
+        return component_table(self._axial_points(bin_image), compact=self.precision.compact_indices)
+
+    def skeleton(self, skeleton_components: Output):
+        return select_components(
+            skeleton_components, self._keep_sizes(skeleton_components.sizes, skeleton_components.ccs.size)
+        )
+
+    def skeleton_index(self, skeleton: Output):
+        return MomentIndex(skeleton, compact=self.precision.compact_indices)
 
-        skeleton = np.zeros_like(bin_image)
+    def _axial_points(self, bin_image):
+        """
+        Local maxima of the distance transform above `threshold_abs`, plateaus included, same as
+        `peak_local_max(dist, min_distance=1, threshold_abs=threshold_abs, labels=bin_image)`.
+        """
+        dist = distance_transform_edt(bin_image, num_threads=self.execution.threads)
+        dist = dist.astype(self.precision.float_dtype, copy=False)
+        # peak_local_max excludes the image border, both as peaks and as neighbours of peaks
+        dist[[0, -1]] = dist[:, [0, -1]] = 0
 
-        for point in peaks:
-            skeleton[*point] = True
+        skeleton = dist == ndimage.maximum_filter(dist, size=3, mode='constant')
+        # Background is zero, so the threshold also masks by `bin_image`
+        skeleton &= dist > self.threshold_abs
 
         if self.dilation_radius > 0:
-            skeleton = binary_dilation(skeleton, disk(self.dilation_radius))
+            skeleton = disk_dilation(skeleton, self.dilation_radius, num_threads=self.execution.threads)
 
-        ccs, labels, sizes = label(skeleton, return_labels=True, return_sizes=True)
+        return skeleton
 
-        return np.isin(ccs, labels[sizes >= self.min_size])
+    def _keep_sizes(self, sizes, image_size):
+        return sizes >= self.min_size
+
+    def _halo(self):
+        return EDT_HALO + self.dilation_radius + 2
 
 
 class LineFittingTLS(Transform):
@@ -81,7 +352,8 @@ class LineFittingTLS(Transform):
     def image_lined(self, fitting_results: Output):
         return visualize_fitting(fitting_results)
 
-    def fitting_results(self, skeleton, bin_image):
+    def fitting_results(self, skeleton, bin_image, skeleton_index=None):
+        """Block moments are taken from `skeleton_index`, computed from `skeleton` if there is none."""
         filtration_image = bin_image if self.use_filtration_image else None
 
         return blocked_line_fitting_tls(
@@ -90,4 +362,35 @@ class LineFittingTLS(Transform):
             block=self.block,
             filtration_image=filtration_image,
             filtration_thr=self.filtration_thr,
+            moment_index=skeleton_index,
+        )
+
+
+class FiberThickness(Transform):
+    precision = DEFAULT_PRECISION
+    execution = DEFAULT_EXECUTION
+
+    def __init__(self, profile_radius=2, pixel_spacing=1.0):
+        self.profile_radius = profile_radius
+        self.pixel_spacing = pixel_spacing
+
+    def distance(self, bin_image):
+        distance = distance_transform_edt(bin_image, num_threads=self.execution.threads)
+
+        return distance.astype(self.precision.float_dtype, copy=False)
+
+    def fiber_segments(self, fitting_results, distance: Output):
+        measured = measure_fibers(fitting_results, distance, self.profile_radius)
+        scale = self.pixel_spacing
+
+        return FiberSegmentTable(
+            x=measured['x'] * scale,
+            y=measured['y'] * scale,
+            angle=measured['angle'],
+            length=measured['length'] * scale,
+            diameter=measured['diameter'] * scale,
+            pixel_spacing=scale,
         )
+
+    def _halo(self):
+        return EDT_HALO
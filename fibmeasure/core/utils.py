@@ -1,7 +1,92 @@
 import base64
+import hashlib
 import io
+import math
+import os
+import tempfile
+from functools import cache
+from pathlib import Path
+
 import numpy as np
+import tifffile
 from PIL import Image
+from skimage.color import rgb2gray, rgba2rgb
+from skimage.io import imread
+
+
+# Rows of the source converted to float32 at once when ingesting a memory-mapped image
+INGEST_CHUNK_PIXELS = 2**24
+CGROUP_ROOT = Path('/sys/fs/cgroup')
+
+
+def _cpu_quota(directory, v2):
+    try:
+        if v2:
+            quota, period = (directory / 'cpu.max').read_text().split()
+            if quota == 'max':
+                return None
+        else:
+            quota = (directory / 'cpu.cfs_quota_us').read_text()
+            period = (directory / 'cpu.cfs_period_us').read_text()
+
+        quota, period = int(quota), int(period)
+    except (OSError, ValueError):
+        return None
+
+    return max(1, math.ceil(quota / period)) if quota > 0 else None
+
+
+def _cgroup_cpu_limit():
+    """
+    CPU quota of the cgroup of the process, None if unlimited or unknown. The cgroup is taken from
+    `/proc/self/cgroup`, quotas of its ancestors apply as well. A cgroup missing from the mount, e.g. a host path
+    seen from a container, falls back to its nearest visible ancestor.
+    """
+    try:
+        with open('/proc/self/cgroup', 'r') as file:
+            lines = file.read().splitlines()
+    except OSError:
+        return None
+
+    limits = []
+    for line in lines:
+        _, controllers, path = line.split(':', 2)
+
+        # cgroup v2 has no controller list and is mounted apart from v1 controllers on hybrid hosts
+        v2 = not controllers
+        if v2:
+            mounts = [CGROUP_ROOT, CGROUP_ROOT / 'unified']
+            mounts = [mount for mount in mounts if (mount / 'cgroup.controllers').exists()]
+        elif 'cpu' in controllers.split(','):
+            mounts = [mount for mount in (CGROUP_ROOT / controllers, CGROUP_ROOT / 'cpu') if mount.is_dir()]
+        else:
+            continue
+
+        if not mounts:
+            continue
+
+        mount = mounts[0]
+
+        directory = mount / path.lstrip('/')
+        while True:
+            if directory.is_dir():
+                limits.append(_cpu_quota(directory, v2))
+            if directory == mount:
+                break
+            directory = directory.parent
+
+    limits = [limit for limit in limits if limit is not None]
+
+    return min(limits) if limits else None
+
+
+@cache
+def available_cpus():
+    """CPUs the process may run on, bounded by its affinity mask and its cgroup CPU quota."""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    limit = _cgroup_cpu_limit()
+
+    return cpus if limit is None else min(cpus, limit)
 
 
 def np_grayscale_to_base64(img):
@@ -15,3 +100,119 @@ def np_grayscale_to_base64(img):
     Image.fromarray(img8, mode="L").save(buf, format="PNG")
 
     return base64.b64encode(buf.getvalue()).decode("utf-8")
+
+
+def downscale_mean(image, factor, chunk_pixels=2**24):
+    """
+    `image` reduced `factor` times by averaging `factor` x `factor` blocks, incomplete blocks at the bottom
+    and right edges are dropped. Memory-mapped images are read in bands of about `chunk_pixels`.
+    """
+    height, width = image.shape[0] // factor, image.shape[1] // factor
+    dtype = image.dtype if np.issubdtype(image.dtype, np.floating) else np.float32
+    downscaled = np.empty((height, width), dtype=dtype)
+    band_rows = max(1, chunk_pixels // (factor * factor * max(width, 1)))
+
+    for start in range(0, height, band_rows):
+        stop = min(start + band_rows, height)
+        band = np.asarray(image[start * factor : stop * factor, : width * factor], dtype=dtype)
+        downscaled[start:stop] = band.reshape(stop - start, factor, width, factor).mean(axis=(1, 3))
+
+    return downscaled
+
+
+def _as_gray_float32(image):
+    # Same conversion as imread(..., as_gray=True).astype(np.float32), pixel-wise, so it works on chunks
+    if image.ndim > 2:
+        if image.shape[-1] == 4:
+            image = rgba2rgb(image)
+        image = rgb2gray(image)
+
+    return image.astype(np.float32)
+
+
+def array_digest(array, chunk_bytes=2**26):
+    """Hex digest of the shape, dtype and contents of an array, memory-mapped arrays are hashed in bands."""
+    digest = hashlib.blake2b(f'{array.shape}{array.dtype.str}'.encode('utf-8'), digest_size=16)
+    rows = max(1, chunk_bytes // max(1, array[:1].nbytes))
+
+    for start in range(0, len(array), rows):
+        digest.update(np.ascontiguousarray(array[start : start + rows]).data)
+
+    return digest.hexdigest()
+
+
+def default_cache_dir():
+    return Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'fibmeasure'
+
+
+def parse_bytes(value):
+    """Number of bytes of a size like `512M` or `16G`, powers of 1024."""
+    units = {'k': 1024, 'm': 1024**2, 'g': 1024**3, 't': 1024**4}
+    value = value.strip().lower().removesuffix('b')
+
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+
+    return int(value)
+
+
+def temporary_memmap(shape, dtype, scratch_dir=None):
+    """Memory map of an anonymous temporary file, removed as soon as the map is released."""
+    file = tempfile.TemporaryFile(dir=scratch_dir, prefix='fibmeasure-')
+
+    return np.memmap(file, dtype=dtype, mode='w+', shape=shape)
+
+
+def spill_to_memmap(array, scratch_dir=None):
+    spilled = temporary_memmap(array.shape, array.dtype, scratch_dir)
+    spilled[...] = array
+
+    return spilled
+
+
+def _map_image(path, raw_shape=None, raw_dtype=None):
+    suffix = Path(path).suffix.lower()
+
+    if suffix in ('.tif', '.tiff'):
+        try:
+            return tifffile.memmap(path, mode='r')
+        except ValueError:
+            # Compressed or tiled TIFFs can not be mapped
+            return None
+
+    if suffix == '.npy':
+        return np.load(path, mmap_mode='r')
+
+    if suffix == '.raw':
+        if raw_shape is None or raw_dtype is None:
+            raise ValueError(f'Reading {path} requires raw_shape and raw_dtype')
+
+        return np.memmap(path, dtype=raw_dtype, mode='r', shape=tuple(raw_shape))
+
+    return None
+
+
+def read_grayscale_image(path, mmap=False, scratch_dir=None, raw_shape=None, raw_dtype=None):
+    """
+    Grayscale float32 image.
+
+    With `mmap` uncompressed TIFF inputs are memory-mapped instead of read, `.npy` inputs and headerless `.raw`
+    inputs of `raw_shape` and `raw_dtype` are always mapped. A float32 grayscale source is returned as a read-only map,
+    other sources are converted chunk by chunk into a map of a temporary file in `scratch_dir`.
+    Other formats are read into memory.
+    """
+    mmap = mmap or Path(path).suffix.lower() in ('.npy', '.raw')
+    mapped = _map_image(path, raw_shape, raw_dtype) if mmap else None
+
+    if mapped is None:
+        return imread(path, as_gray=True).astype(np.float32)
+
+    if mapped.ndim == 2 and mapped.dtype == np.float32:
+        return mapped
+
+    image = temporary_memmap(mapped.shape[:2], np.float32, scratch_dir)
+    rows = max(1, INGEST_CHUNK_PIXELS // max(1, mapped.shape[1]))
+    for start in range(0, mapped.shape[0], rows):
+        image[start : start + rows] = _as_gray_float32(np.asarray(mapped[start : start + rows]))
+
+    return image
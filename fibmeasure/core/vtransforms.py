@@ -17,6 +17,8 @@ class SliderParams:
     step: Param
     dtype: type
     annotation: str | None = None
+    # How the value follows the image resolution: 'length' for distances in pixels, 'area' for pixel counts
+    preview_scaling: str | None = None
 
 
 class TransformView:
@@ -46,8 +48,22 @@ class TransformView:
     def visualization_key(self):
         return self._visualization_key
 
-    def __call__(self, node):
-        return self._transform(node)
+    @property
+    def output_names(self):
+        return self._transform._transform_order
+
+    @property
+    def input_names(self):
+        """Names of the node values the transform reads."""
+        return {
+            name for spec in self._transform._name2transform_spec.values() for name in spec.params if name != 'self'
+        }
+
+    def __call__(self, node, reuse=None):
+        return self._transform(node, reuse)
+
+    def stale_outputs(self, changed_params=(), changed_inputs=()):
+        return self._transform.stale_outputs(changed_params, changed_inputs)
 
     def set_visualization_key(self, visualization_key):
         self._visualization_key = visualization_key
@@ -61,9 +77,52 @@ class TransformView:
                     f'{self._transform.__class__.__name__} has multiple transformation fields, provide visualization_key manually'
                 )
 
+    def set_precision(self, precision):
+        self._transform.precision = precision
+
+    def set_execution(self, execution):
+        self._transform.execution = execution
+        # Independent outputs run concurrently as well, the pool is bounded by the same number of threads
+        self._transform.max_workers = execution.threads
+
+    def set_pixel_spacing(self, pixel_spacing):
+        if hasattr(self._transform, 'pixel_spacing'):
+            self._transform.pixel_spacing = pixel_spacing
+
     def set_current_value(self, name, value):
         setattr(self._transform, name, value)
 
+    def get_params(self):
+        return {name: getattr(self._transform, name) for name in self._slider_configs}
+
+    def get_state(self):
+        """Public attributes of the transform that its outputs depend on, the parameters among them."""
+        # The number of threads does not change the outputs
+        return {
+            name: value
+            for name, value in vars(self._transform).items()
+            if not name.startswith('_') and name not in ('execution', 'max_workers')
+        }
+
+    def get_scaled_params(self, scale):
+        """Parameters for the image resized by `scale`, pixel distances and counts are kept in the slider range."""
+        params = self.get_params()
+
+        for name, slider_config in self._slider_configs.items():
+            match slider_config.preview_scaling:
+                case 'length':
+                    value = params[name] * scale
+                case 'area':
+                    value = params[name] * scale**2
+                case _:
+                    continue
+
+            if slider_config.dtype is int:
+                value = round(value)
+            params[name] = min(max(value, slider_config.min), slider_config.max)
+
+        return params
+
     def get_sliders(self):
         sliders = {}
 
@@ -97,7 +156,7 @@ def _config2view_params(config):
             slider_params_parsed['dtype'] = dtype
 
             for slider_param_name, slider_param_value in value.items():
-                if slider_param_name != 'dtype' and slider_param_name != 'annotation' and slider_param_name != 'view_name':
+                if slider_param_name not in ('dtype', 'annotation', 'view_name', 'preview_scaling'):
                     slider_params_parsed[slider_param_name] = dtype(slider_param_value)
 
             view_params[name] = SliderParams(**slider_params_parsed)
@@ -107,6 +166,14 @@ def _config2view_params(config):
     return view_params
 
 
+def transform_views_from_config(config):
+    """Transform chain described by a config in the `transform_views.yaml` format, in the config order."""
+    return [
+        TransformView(getattr(transforms, name), **_config2view_params(transform_config))
+        for name, transform_config in config.items()
+    ]
+
+
 @cache
 def __getattr__(name):
     if name == "__path__":
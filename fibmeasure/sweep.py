@@ -0,0 +1,206 @@
+import csv
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+import numpy as np
+import yaml
+
+from .batch import collect_images, load_params
+from .core.cache import DiskCache
+from .core.stats import FiberStatistics
+from .core.transform_handler import DEFAULT_CACHE_BYTES, DEFAULT_DISK_CACHE_BYTES, TransformHandler
+from .core.transforms import ExecutionContext
+from .core.utils import available_cpus, read_grayscale_image
+from .core.vtransforms import transform_views_from_config
+
+
+def load_grid(path):
+    with open(path, 'r', encoding='utf-8') as file:
+        return yaml.safe_load(file)
+
+
+def slider_values(slider, num=None):
+    """Values on the step grid of a slider config in the `transform_views.yaml` format, `num` evenly spaced if given."""
+    if slider['dtype'] == 'bool':
+        values = [False, True]
+    else:
+        dtype = int if slider['dtype'] == 'int' else float
+        low, high, step = float(slider['min']), float(slider['max']), float(slider['step'])
+        count = int(round((high - low) / step)) + 1
+        # Rounded so that float steps give the values a slider shows
+        values = [dtype(round(low + i * step, 10)) for i in range(count)]
+
+    if num is not None and num < len(values):
+        values = [values[i] for i in dict.fromkeys(np.linspace(0, len(values) - 1, num).round().astype(int))]
+
+    return values
+
+
+def expand_grid(grid, config=None):
+    """
+    Parameter combinations of `grid`, `{transform name: {parameter: values}}`, in the prefix order of the chain.
+
+    Values are a list, a number of evenly spaced slider values or `None` for every slider value.
+    A combination is a tuple of `(transform name, parameter, value)` ordered by the chain of `config`,
+    combinations are sorted so that those sharing upstream parameter values are adjacent: every distinct
+    prefix of the chain is computed once when combinations run in this order.
+    """
+    config = load_params() if config is None else config
+    chain = list(config)
+    axes = []
+
+    for transform_name in sorted(grid, key=chain.index):
+        for name, values in grid[transform_name].items():
+            if not isinstance(values, (list, tuple)):
+                values = slider_values(config[transform_name][name], values)
+
+            axes.append([(transform_name, name, value) for value in values])
+
+    return list(itertools.product(*axes))
+
+
+def _flat_summary(statistics):
+    summary = statistics.summary()
+    quantiles = summary.pop('diameter_quantiles')
+
+    return {**summary, **{f'diameter_q{q:g}': value for q, value in quantiles.items()}}
+
+
+def _error_row(image_path, combination, error):
+    return {
+        'image': str(image_path),
+        'status': 'error',
+        **{f'{transform_name}.{name}': value for transform_name, name, value in combination},
+        'error': f'{type(error).__name__}: {error}',
+    }
+
+
+def sweep_image(
+    image_path,
+    config,
+    combinations,
+    threads=None,
+    cache_dir=None,
+    cache_bytes=DEFAULT_DISK_CACHE_BYTES,
+    pixel_spacing=1.0,
+    raw_shape=None,
+    raw_dtype=None,
+    memory_bytes=DEFAULT_CACHE_BYTES,
+    diameter_bin_width=None,
+):
+    """
+    Metrics of every combination for one image, one row per combination, in units of `pixel_spacing`.
+    Step outputs are cached in memory within `memory_bytes`.
+    """
+    transforms = transform_views_from_config(config)
+    chain = list(config)
+    disk_cache = None if cache_dir is None else DiskCache(cache_dir, cache_bytes)
+    handler = TransformHandler(
+        read_grayscale_image(image_path, raw_shape=raw_shape, raw_dtype=raw_dtype),
+        transforms=transforms,
+        cache_bytes=memory_bytes,
+        execution=ExecutionContext(threads),
+        pixel_spacing=pixel_spacing,
+        disk_cache=disk_cache,
+    )
+    rows = []
+
+    for combination in combinations:
+        for transform_name, name, value in combination:
+            transforms[chain.index(transform_name)].set_current_value(name, value)
+
+        start = perf_counter()
+        node = handler.get_result_node(len(transforms) - 1)
+        seconds = perf_counter() - start
+
+        outputs = [node[name] for name in ('fiber_segments', 'fitting_results') if name in node]
+        statistics = FiberStatistics.for_pixel_spacing(pixel_spacing, diameter_bin_width).update(*outputs)
+        rows.append(
+            {
+                'image': str(image_path),
+                'status': 'ok',
+                **{f'{transform_name}.{name}': value for transform_name, name, value in combination},
+                **_flat_summary(statistics),
+                'seconds': seconds,
+            }
+        )
+
+    return rows
+
+
+def run_sweep(
+    inputs,
+    grid,
+    config=None,
+    workers=None,
+    threads=None,
+    cache_dir=None,
+    cache_bytes=DEFAULT_DISK_CACHE_BYTES,
+    pixel_spacing=1.0,
+    raw_shape=None,
+    raw_dtype=None,
+    memory_limit=DEFAULT_CACHE_BYTES,
+    diameter_bin_width=None,
+):
+    """
+    Metrics of every combination of `grid` (see `expand_grid`) over images, a list of rows, one per image
+    and combination.
+
+    Work is split by image and by the values of the first parameter of the grid, so that branches of the
+    prefix tree run in parallel processes while every branch computes its prefixes once. Steps upstream of
+    the first parameter are computed in every branch, unless `cache_dir` gives the processes a shared `DiskCache`.
+    Every process caches step outputs in memory within its share of `memory_limit` (bytes), in the prefix order
+    only outputs of the current chain are reused, so a small budget does not cause recomputation.
+    A failing image does not stop the sweep, its combinations get rows with the `error` status and message.
+    """
+    config = load_params() if config is None else config
+    combinations = expand_grid(grid, config)
+    workers = workers or available_cpus()
+    threads = threads or max(1, available_cpus() // workers)
+    memory_bytes = memory_limit // workers
+
+    branches = {}
+    for combination in combinations:
+        branches.setdefault(combination[0] if combination else None, []).append(combination)
+
+    images = collect_images(inputs)
+    with ProcessPoolExecutor(workers) as executor:
+        futures = {
+            (image_path, first): executor.submit(
+                sweep_image,
+                image_path,
+                config,
+                branch,
+                threads,
+                cache_dir,
+                cache_bytes,
+                pixel_spacing,
+                raw_shape,
+                raw_dtype,
+                memory_bytes,
+                diameter_bin_width,
+            )
+            for image_path in images
+            for first, branch in branches.items()
+        }
+
+        rows = []
+        for image_path in images:
+            image_rows = {}
+            for first, branch in branches.items():
+                try:
+                    image_rows.update(zip(branch, futures[image_path, first].result()))
+                except Exception as e:
+                    image_rows.update((combination, _error_row(image_path, combination, e)) for combination in branch)
+
+            rows.extend(image_rows[combination] for combination in combinations)
+
+    return rows
+
+
+def write_table(rows, path):
+    with open(path, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=list(dict.fromkeys(key for row in rows for key in row)))
+        writer.writeheader()
+        writer.writerows(rows)
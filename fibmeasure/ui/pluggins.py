@@ -30,6 +30,10 @@ class HoldButton(ft.GestureDetector):
             on_exit=lambda e: self._end_hold(e),
         )
 
+    @property
+    def holding(self):
+        return self._holding
+
     @property
     def disabled(self):
         return self._disabled
@@ -1,13 +1,35 @@
+import os
+
 import flet as ft
-import numpy as np
-from skimage.io import imread
 
 from .pluggins import HoldButton
+from fibmeasure.core.background import Cancelled, LatestJobWorker
+from fibmeasure.core.cache import DiskCache
+from fibmeasure.core.display import DEFAULT_DISPLAY_SIZE, DisplayEncoder
 from fibmeasure.core.transform_handler import TransformHandler
-from fibmeasure.core.utils import np_grayscale_to_base64
+from fibmeasure.core.utils import default_cache_dir, parse_bytes, read_grayscale_image
 
 
 SLIDER_TEXT_ANNOTATION_WIDTH_PX = 500
+ZOOM_STEP = 1.25
+MAX_ZOOM = 64.0
+# Sources from this size on are memory-mapped and their cached results are spilled to scratch files
+LARGE_IMAGE_PIXELS = 64 * 2**20
+# Results are kept between sessions only when one of these is set: the cache directory, by default under
+# `default_cache_dir()`, and its size budget, e.g. 4G. Cache entries are unpickled, use a directory only you write to
+DISK_CACHE_DIR_ENV = 'FIBMEASURE_CACHE_DIR'
+DISK_CACHE_SIZE_ENV = 'FIBMEASURE_CACHE_SIZE'
+DEFAULT_UI_DISK_CACHE_BYTES = 2 * 1024**3
+
+
+def disk_cache_from_env():
+    cache_dir, cache_size = os.environ.get(DISK_CACHE_DIR_ENV), os.environ.get(DISK_CACHE_SIZE_ENV)
+    if not cache_dir and not cache_size:
+        return None
+
+    cache_bytes = parse_bytes(cache_size) if cache_size else DEFAULT_UI_DISK_CACHE_BYTES
+
+    return DiskCache(cache_dir or default_cache_dir(), cache_bytes)
 
 
 class TransformView(ft.View):
@@ -17,10 +39,29 @@ class TransformView(ft.View):
 
         source_path = page.session.get("source_path")
 
-        source_image = imread(source_path, as_gray=True).astype(np.float32)
-        self._buffer_image = np_grayscale_to_base64(source_image)
-
-        self.transform_manager = TransformHandler(source_image)
+        source_image = read_grayscale_image(
+            source_path,
+            mmap=True,
+            raw_shape=page.session.get("raw_shape"),
+            raw_dtype=page.session.get("raw_dtype"),
+        )
+        self.source_image = source_image
+        # Both panes show the same part of their images, `center` is the fraction of the image height and width
+        self.zoom = 1.0
+        self.center = (0.5, 0.5)
+        self.encoder = DisplayEncoder()
+        self._buffer_image = self.encode(source_image)
+
+        self.transform_manager = TransformHandler(
+            source_image,
+            spill=source_image.size >= LARGE_IMAGE_PIXELS,
+            pixel_spacing=page.session.get("pixel_spacing") or 1.0,
+            # With the disk cache enabled reopening the same image resumes from results of earlier sessions
+            disk_cache=disk_cache_from_env(),
+        )
+        # The handler is only used by the worker once the view is built, event handlers submit jobs to it
+        self.worker = LatestJobWorker()
+        self._shown_transform_idx = self.transform_manager.current_transform_idx
 
         self.prev_btn = ft.CupertinoFilledButton("Previous", on_click=self.prev_click)
         self.next_btn = ft.CupertinoFilledButton("Next", on_click=self.next_click)
@@ -58,12 +99,18 @@ class TransformView(ft.View):
                                 [
                                     self.header_text,
                                     self.transform_annotation_text,
-                                    ft.Row(
-                                        [
-                                            self.before_image,
-                                            self.after_image
-                                        ],
-                                        alignment=ft.MainAxisAlignment.CENTER,
+                                    ft.GestureDetector(
+                                        ft.Row(
+                                            [
+                                                self.before_image,
+                                                self.after_image
+                                            ],
+                                            alignment=ft.MainAxisAlignment.CENTER,
+                                            expand=True
+                                        ),
+                                        on_scroll=self.on_image_scroll,
+                                        on_pan_update=self.on_image_pan,
+                                        on_double_tap=self.on_image_double_tap,
                                         expand=True
                                     ),
                                 ],
@@ -98,7 +145,7 @@ class TransformView(ft.View):
             )
         ]
 
-        self.update_images()
+        self.request_images()
 
     def swap_right_image_with_buffer_image(self, e):
         tmp = self._buffer_image
@@ -118,10 +165,93 @@ class TransformView(ft.View):
         self.next_btn.disabled = False
         self.show_source_btn.disabled = False
 
-    def update_images(self):
-        before_image, after_image = self.transform_manager.get_before_after_images()
-        self.before_image.src_base64 = np_grayscale_to_base64(before_image)
-        self.after_image.src_base64 = np_grayscale_to_base64(after_image)
+    def encode(self, image):
+        return self.encoder(image, self.display_size(), self.zoom, self.center)
+
+    def display_size(self):
+        """Size of one image pane, the before and after images share the width of the page."""
+        if not self.page.width or not self.page.height:
+            return DEFAULT_DISPLAY_SIZE
+
+        return max(1, int(self.page.width) // 2), max(1, int(self.page.height))
+
+    def request_images(self, update=None, disable_buttons=True):
+        """
+        Recomputes and renders the images in the background after `update()`, newer requests supersede it.
+        Without `disable_buttons`, e.g. for a new view of the same images, only the source button is disabled.
+        """
+        if disable_buttons:
+            self.disable_buttons()
+        else:
+            # The buffered source is of the old view until the job finishes
+            self.show_source_btn.disabled = True
+        self.page.update()
+
+        self.worker.submit(self.compute_images, self.show_images, update)
+
+    def compute_images(self, cancelled):
+        """Shows the preview of large sources first, then returns the full-resolution images."""
+        transform_idx = self.transform_manager.current_transform_idx
+        if self.transform_manager.preview_factor > 1 and not self.transform_manager.is_computed(transform_idx):
+            preview = self.transform_manager.get_preview_before_after_images(cancelled)
+            self.show_images(self.encode_images(preview, cancelled), final=False)
+
+        return self.encode_images(self.transform_manager.get_before_after_images(cancelled), cancelled)
+
+    def encode_images(self, images, cancelled):
+        before_image, after_image = images
+        before_base64 = self.encode(before_image)
+        after_base64 = self.encode(after_image)
+        if cancelled():
+            raise Cancelled
+
+        return self.transform_manager.current_transform_idx, before_base64, after_base64
+
+    def show_images(self, images, final=True):
+        transform_idx, self.before_image.src_base64, after_base64 = images
+        source_base64 = self.encode(self.source_image) if final else None
+
+        # While the source button is held the source is shown in place of the after image, swapped back on release
+        if self.show_source_btn.holding:
+            self._buffer_image = after_base64
+            if final:
+                self.after_image.src_base64 = source_base64
+        else:
+            self.after_image.src_base64 = after_base64
+            if final:
+                self._buffer_image = source_base64
+
+        if transform_idx != self._shown_transform_idx:
+            self._shown_transform_idx = transform_idx
+            self.header_text.value = f"Transform {self.transform_manager.current_transform_name}"
+            self.transform_annotation_text.value = self.transform_manager.current_transform_annotation
+
+            new_sliders = self.build_slider_view_content()
+            self.slider_view.controls.clear()
+            self.slider_view.controls.extend(new_sliders)
+
+        if final:
+            self.enable_buttons()
+        self.page.update()
+
+    def on_image_scroll(self, e: ft.ScrollEvent):
+        zoom = self.zoom / ZOOM_STEP if e.scroll_delta_y > 0 else self.zoom * ZOOM_STEP
+        self.zoom = min(max(zoom, 1.0), MAX_ZOOM)
+        self.request_images(disable_buttons=False)
+
+    def on_image_pan(self, e: ft.DragUpdateEvent):
+        width, height = self.display_size()
+        # Image pixels per screen pixel at zoom 1
+        scale = max(self.source_image.shape[0] / height, self.source_image.shape[1] / width)
+        shift_y = e.delta_y * scale / (self.zoom * self.source_image.shape[0])
+        shift_x = e.delta_x * scale / (self.zoom * self.source_image.shape[1])
+
+        self.center = (min(max(self.center[0] - shift_y, 0.0), 1.0), min(max(self.center[1] - shift_x, 0.0), 1.0))
+        self.request_images(disable_buttons=False)
+
+    def on_image_double_tap(self, e):
+        self.zoom, self.center = 1.0, (0.5, 0.5)
+        self.request_images(disable_buttons=False)
 
     def update_slider_text(self, name, view_name, value):
         if isinstance(value, float):
@@ -180,43 +310,15 @@ class TransformView(ft.View):
         return view_content
 
     def on_slider_change(self, e: ft.ControlEvent):
-        self.disable_buttons()
-        self.page.update()
-
         name = e.control.data
-        value = e.control.value
-        value_type = self.name2value_type[name]
-        view_name = self.name2view_name[name]
+        value = self.name2value_type[name](e.control.value)
+        transform = self.transform_manager.transforms[self._shown_transform_idx]
 
-        self.transform_manager.update_param(name, value_type(value))
-        self.update_images()
-        self.update_slider_text(name, view_name, value_type(value))
-
-        self.enable_buttons()
-        self.page.update()
+        self.update_slider_text(name, self.name2view_name[name], value)
+        self.request_images(lambda: transform.set_current_value(name, value))
 
     def prev_click(self, e):
-        if self.transform_manager.prev():
-            self.header_text.value = f"Transform {self.transform_manager.current_transform_name}"
-            self.transform_annotation_text.value = self.transform_manager.current_transform_annotation
-
-            self.update_images()
-
-            new_sliders = self.build_slider_view_content()
-            self.slider_view.controls.clear()
-            self.slider_view.controls.extend(new_sliders)
-
-            self.page.update()
+        self.request_images(self.transform_manager.prev)
 
     def next_click(self, e):
-        if self.transform_manager.next():
-            self.header_text.value = f"Transform {self.transform_manager.current_transform_name}"
-            self.transform_annotation_text.value = self.transform_manager.current_transform_annotation
-
-            self.update_images()
-
-            new_sliders = self.build_slider_view_content()
-            self.slider_view.controls.clear()
-            self.slider_view.controls.extend(new_sliders)
-
-            self.page.update()
+        self.request_images(self.transform_manager.next)
@@ -1,4 +1,7 @@
+from pathlib import Path
+
 import flet as ft
+import numpy as np
 
 
 def is_valid_pixel_spacing(pixel_spacing):
@@ -9,6 +12,28 @@ def is_valid_pixel_spacing(pixel_spacing):
         return False
 
 
+def parse_raw_shape(raw_shape):
+    """`height x width` as a tuple of two positive ints, None if it is not one."""
+    try:
+        shape = tuple(int(size) for size in raw_shape.lower().replace(',', 'x').split('x'))
+    except (AttributeError, ValueError):
+        return None
+
+    return shape if len(shape) == 2 and min(shape) > 0 else None
+
+
+def is_valid_raw_dtype(raw_dtype):
+    try:
+        np.dtype(raw_dtype)
+        return True
+    except TypeError:
+        return False
+
+
+def is_raw(path):
+    return path is not None and Path(path).suffix.lower() == '.raw'
+
+
 class UploadView(ft.View):
     def __init__(self, page: ft.Page):
         super().__init__(route="upload")
@@ -29,6 +54,22 @@ class UploadView(ft.View):
             helper_text='Must be a positive real number, separator - a period',
             on_change=self.pixel_spacing_on_change,
         )
+        # Headerless raw images carry no shape and pixel type, they are asked for once such a file is chosen
+        self.raw_shape_tf = ft.TextField(
+            label="Raw image shape",
+            width=600,
+            helper_text='Height x width in pixels, e.g. 2048x2048',
+            visible=False,
+            on_change=self.raw_on_change,
+        )
+        self.raw_dtype_tf = ft.TextField(
+            label="Raw pixel type",
+            width=600,
+            value='uint16',
+            helper_text='e.g. uint8, uint16 or float32',
+            visible=False,
+            on_change=self.raw_on_change,
+        )
 
         self.controls = [
             ft.Container(
@@ -38,6 +79,8 @@ class UploadView(ft.View):
                         self.choose_btn,
                         self.image_preview,
                         self.pixel_spacing_tf,
+                        self.raw_shape_tf,
+                        self.raw_dtype_tf,
                         self.next_btn,
                     ],
                     alignment=ft.MainAxisAlignment.CENTER,
@@ -60,21 +103,40 @@ class UploadView(ft.View):
 
         self.page.update()
 
+    def raw_on_change(self, e):
+        if parse_raw_shape(self.raw_shape_tf.value) is None:
+            self.raw_shape_tf.error_text = 'Invalid shape. Must be height x width, e.g. 2048x2048'
+        else:
+            self.raw_shape_tf.error_text = None
+        self.raw_dtype_tf.error_text = None if is_valid_raw_dtype(self.raw_dtype_tf.value) else 'Unknown pixel type'
+
+        self.page.update()
+
+    def is_valid_raw(self):
+        return not is_raw(self.source_path) or (
+            parse_raw_shape(self.raw_shape_tf.value) is not None and is_valid_raw_dtype(self.raw_dtype_tf.value)
+        )
+
     def pick_file(self, e):
         self.file_picker.pick_files(allow_multiple=False)
 
     def on_file_picked(self, e: ft.FilePickerResultEvent):
         if e.files:
             self.source_path = e.files[0].path
-            self.image_preview.src = self.source_path
+            # Raw images can not be previewed before their shape is known
+            self.image_preview.src = None if is_raw(self.source_path) else self.source_path
+            self.raw_shape_tf.visible = self.raw_dtype_tf.visible = is_raw(self.source_path)
             self.next_btn.disabled = False  # Make button "Next step" active
             self.page.update()
 
     def next_button_click(self, e):
-        if is_valid_pixel_spacing(self.pixel_spacing_tf.value):
+        if is_valid_pixel_spacing(self.pixel_spacing_tf.value) and self.is_valid_raw():
             self.next_step(e)
 
     def next_step(self, e):
         self.page.session.set("source_path", self.source_path)
         self.page.session.set("pixel_spacing", float(self.pixel_spacing_tf.value))
+        if is_raw(self.source_path):
+            self.page.session.set("raw_shape", parse_raw_shape(self.raw_shape_tf.value))
+            self.page.session.set("raw_dtype", self.raw_dtype_tf.value)
         self.page.go("transform")
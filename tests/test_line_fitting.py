@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from fibmeasure.benchmarks.common import random_lines_mask
+from fibmeasure.benchmarks.line_fitting import blocked_line_fitting_tls_loop, visualize_fitting_loop
+from fibmeasure.core.ops import MomentIndex, blocked_line_fitting_tls, visualize_fitting
+
+
+@pytest.fixture(scope='module')
+def skeleton():
+    return random_lines_mask((300, 317), 12)
+
+
+def assert_same_lines(params, expected):
+    np.testing.assert_array_equal(params[..., 3], expected[..., 3])
+
+    # (A, B, C) and (-A, -B, -C) describe the same line
+    valid = expected[..., 3] != 0
+    lines, expected_lines = params[valid, :3], expected[valid, :3]
+    signs = np.where(np.sum(lines * expected_lines, axis=-1) < 0, -1, 1)
+    np.testing.assert_allclose(lines * signs[:, None], expected_lines, rtol=0, atol=1e-3)
+
+
+@pytest.mark.parametrize('compact', [None, False, True])
+@pytest.mark.parametrize('block', [16, 32, 64])
+@pytest.mark.parametrize('use_filtration_image', [False, True])
+def test_vectorized_equals_loop(skeleton, compact, block, use_filtration_image):
+    filtration_image = skeleton | np.roll(skeleton, 1, axis=0) if use_filtration_image else None
+    moment_index = None if compact is None else MomentIndex(skeleton, compact=compact)
+    kwargs = dict(linearity_thr=50, block=block, filtration_image=filtration_image, filtration_thr=0.5)
+
+    expected = blocked_line_fitting_tls_loop(skeleton, **kwargs)
+    fitting = blocked_line_fitting_tls(skeleton, moment_index=moment_index, **kwargs)
+
+    assert np.count_nonzero(expected.fitting_blocked_params[..., 3]) > 0
+    assert fitting.block_size == expected.block_size
+    assert_same_lines(fitting.fitting_blocked_params, expected.fitting_blocked_params)
+
+
+@pytest.mark.parametrize('block', [16, 32, 64])
+@pytest.mark.parametrize(
+    'roi',
+    [
+        None,
+        (slice(None), slice(None)),
+        (slice(10, 100), slice(37, 300)),
+        (slice(0, 1), slice(316, None)),
+        (slice(250, 400), slice(-50, None)),
+        (slice(20, 20), slice(0, 50)),
+    ],
+)
+def test_visualize_equals_loop(skeleton, block, roi):
+    fitting = blocked_line_fitting_tls(skeleton, linearity_thr=50, block=block)
+    expected = visualize_fitting_loop(fitting)
+
+    assert expected.any()
+    if roi is None:
+        np.testing.assert_array_equal(visualize_fitting(fitting), expected)
+    else:
+        np.testing.assert_array_equal(visualize_fitting(fitting, roi=roi), expected[roi])
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from skimage.morphology import binary_dilation, binary_opening, disk
+
+from fibmeasure.benchmarks.common import synthetic_fiber_image
+from fibmeasure.core.morphology import disk_dilation, disk_opening
+
+
+@pytest.fixture(scope='module')
+def masks():
+    rng = np.random.default_rng(0)
+    # Fibers cut by every side of the image
+    border = np.zeros((60, 70), dtype=bool)
+    border[:, 20:35] = border[40:55, :] = border[:8, 50:] = True
+
+    return {
+        'fibers': synthetic_fiber_image((128, 128), 10, thickness=9) > 0.5,
+        'noise': rng.random((96, 97)) > 0.4,
+        'border': border,
+        'all_true': np.ones((40, 45), dtype=bool),
+        'all_false': np.zeros((40, 45), dtype=bool),
+    }
+
+
+@pytest.mark.parametrize('name', ['fibers', 'noise', 'border', 'all_true', 'all_false'])
+@pytest.mark.parametrize('radius', range(17))
+def test_opening_equals_skimage(masks, name, radius):
+    mask = masks[name]
+
+    np.testing.assert_array_equal(disk_opening(mask, radius), binary_opening(mask, disk(radius)))
+
+
+@pytest.mark.parametrize('name', ['fibers', 'noise', 'border', 'all_true', 'all_false'])
+@pytest.mark.parametrize('radius', range(17))
+def test_dilation_equals_skimage(masks, name, radius):
+    mask = masks[name]
+
+    np.testing.assert_array_equal(disk_dilation(mask, radius), binary_dilation(mask, disk(radius)))
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from fibmeasure.benchmarks.common import FIBER_THICKNESS, chain_handler, check_nonempty, synthetic_fiber_image
+from fibmeasure.benchmarks.precision import FLOAT_ATOL, MASK_MISMATCH_FRACTION
+from fibmeasure.core import cache
+from fibmeasure.core.cache import PackedMask, nbytes
+from fibmeasure.core.ops import component_table
+from fibmeasure.core.transforms import DEFAULT_PRECISION, FLOAT64_PRECISION
+
+
+def run_chain(image, precision):
+    handler = chain_handler(image, precision=precision)
+    nodes = [handler.get_result_node(idx) for idx in range(len(handler.transforms))]
+    check_nonempty(nodes)
+
+    return handler, nodes
+
+
+@pytest.fixture(scope='module')
+def chains():
+    image = synthetic_fiber_image((512, 512), 60, thickness=FIBER_THICKNESS)
+
+    return run_chain(image, FLOAT64_PRECISION), run_chain(image, DEFAULT_PRECISION)
+
+
+def test_outputs_within_tolerance(chains):
+    (baseline_handler, baseline_nodes), (handler, nodes) = chains
+
+    for transform, baseline_node, node in zip(handler.transforms, baseline_nodes, nodes):
+        for name in transform.output_names:
+            value, expected = node[name], baseline_node[name]
+            if not isinstance(expected, np.ndarray):
+                continue
+
+            if expected.dtype == bool:
+                assert np.mean(value != expected) <= MASK_MISMATCH_FRACTION, name
+            elif np.issubdtype(expected.dtype, np.floating):
+                assert value.dtype == np.float32, name
+                np.testing.assert_allclose(value, expected, rtol=0, atol=FLOAT_ATOL, err_msg=name)
+
+
+def test_measurements_within_tolerance(chains):
+    (_, baseline_nodes), (_, nodes) = chains
+    expected, segments = baseline_nodes[-1]['fiber_segments'], nodes[-1]['fiber_segments']
+
+    assert len(expected) > 0
+    assert len(segments) == len(expected)
+    for name in ('x', 'y', 'angle', 'length', 'diameter'):
+        np.testing.assert_allclose(getattr(segments, name), getattr(expected, name), rtol=1e-4, err_msg=name)
+
+
+def test_held_memory_halved(chains):
+    (baseline_handler, baseline_nodes), (handler, _) = chains
+    # Every output is held once, label images and moment index tables included
+    outputs = {
+        id(node[name]): node[name]
+        for transform, node in zip(baseline_handler.transforms, baseline_nodes)
+        for name in transform.output_names
+    }
+
+    assert baseline_handler.nbytes == sum(nbytes(value) for value in outputs.values())
+    assert handler.nbytes <= 0.5 * baseline_handler.nbytes
+
+
+def test_unpacked_masks_not_held(chains):
+    handler, _ = run_chain(chains[1][0].source_image, DEFAULT_PRECISION)
+    assert handler.pinned_bytes == 0
+
+    handler.current_transform_idx = 2
+    before, after = handler.get_before_after_images()
+
+    assert before.dtype == after.dtype == bool
+    assert handler.get_before_after_images()[1] is after
+    assert handler.pinned_bytes == before.nbytes + after.nbytes
+
+
+def test_compact_component_labels():
+    mask = np.random.default_rng(0).random((300, 300)) > 0.6
+    table, compact = component_table(mask), component_table(mask, compact=True)
+
+    assert compact.ccs.dtype == np.uint16
+    np.testing.assert_array_equal(compact.ccs, table.ccs)
+    np.testing.assert_array_equal(compact.bboxes, table.bboxes)
+
+
+@pytest.mark.parametrize('shape', [(1, 1), (7, 13), (300, 301)])
+def test_packed_mask_round_trip(shape, monkeypatch):
+    # Several chunks for the larger masks
+    monkeypatch.setattr(cache, 'UNPACK_CHUNK_PIXELS', 64 * 8)
+    mask = np.random.default_rng(0).random(shape) > 0.5
+    packed = PackedMask.pack(mask)
+
+    np.testing.assert_array_equal(packed.unpack(), mask)
+    np.testing.assert_array_equal(packed.unpack(out=np.empty(shape, dtype=bool)), mask)
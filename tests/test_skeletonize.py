@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from imops.morphology import distance_transform_edt
+from skimage.feature import peak_local_max
+
+from fibmeasure.benchmarks.common import synthetic_fiber_image
+from fibmeasure.core.transforms import PrecisionPolicy, SkeletonizeEDT
+
+
+def masks():
+    rng = np.random.default_rng(0)
+    # Even widths give plateaus of maxima
+    bars = np.zeros((64, 80), dtype=bool)
+    bars[10:20, 5:75] = bars[30:60, 40:52] = True
+    # Peaks on the border are excluded
+    border = np.zeros((40, 40), dtype=bool)
+    border[:, 10:21] = border[:12] = True
+
+    return {
+        'fibers': synthetic_fiber_image((256, 256), 20, thickness=9) > 0.5,
+        'noise': rng.random((128, 128)) > 0.3,
+        'bars': bars,
+        'border': border,
+    }
+
+
+@pytest.mark.parametrize('name', ['fibers', 'noise', 'bars', 'border'])
+@pytest.mark.parametrize('float_dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('threshold_abs', [1, 2.5])
+def test_axial_points_equal_peak_local_max(name, float_dtype, threshold_abs):
+    mask = masks()[name]
+    transform = SkeletonizeEDT(threshold_abs=threshold_abs, dilation_radius=0)
+    transform.precision = PrecisionPolicy(float_dtype)
+
+    dist = distance_transform_edt(mask).astype(float_dtype)
+    expected = np.zeros(mask.shape, dtype=bool)
+    expected[tuple(peak_local_max(dist, min_distance=1, threshold_abs=threshold_abs, labels=mask).T)] = True
+
+    np.testing.assert_array_equal(transform._axial_points(mask), expected)
@@ -0,0 +1,71 @@
+import json
+
+import numpy as np
+import pytest
+
+from fibmeasure.core.ops import FiberSegmentTable
+from fibmeasure.core.stats import FiberStatistics
+
+
+def random_segments(rng, num, pixel_spacing=1.0):
+    return FiberSegmentTable(
+        x=rng.uniform(0, 512, num) * pixel_spacing,
+        y=rng.uniform(0, 512, num) * pixel_spacing,
+        angle=rng.uniform(0, np.pi, num),
+        length=rng.uniform(5, 50, num) * pixel_spacing,
+        diameter=rng.gamma(4, 2, num) * pixel_spacing,
+        pixel_spacing=pixel_spacing,
+    )
+
+
+def concatenated(tables):
+    return FiberSegmentTable(
+        **{
+            name: np.concatenate([getattr(table, name) for table in tables])
+            for name in ('x', 'y', 'angle', 'length', 'diameter')
+        },
+        pixel_spacing=tables[0].pixel_spacing,
+    )
+
+
+@pytest.mark.parametrize('pixel_spacing', [1.0, 0.05])
+def test_merged_equals_whole(pixel_spacing):
+    rng = np.random.default_rng(0)
+    parts = [random_segments(rng, num, pixel_spacing) for num in (0, 1, 17, 300)]
+    whole = FiberStatistics.for_pixel_spacing(pixel_spacing).update(concatenated(parts))
+
+    merged = FiberStatistics.for_pixel_spacing(pixel_spacing)
+    for part in parts:
+        merged.merge(FiberStatistics.for_pixel_spacing(pixel_spacing).update(part))
+
+    assert merged.num_lines == whole.num_lines
+    np.testing.assert_array_equal(merged.diameter_histogram.counts, whole.diameter_histogram.counts)
+    assert merged.diameter_histogram.overflow == whole.diameter_histogram.overflow
+    np.testing.assert_array_equal(merged.angle_histogram.counts, whole.angle_histogram.counts)
+    assert merged.diameter_quantiles.buckets == whole.diameter_quantiles.buckets
+    for name in ('diameter', 'length'):
+        expected, moments = getattr(whole, name), getattr(merged, name)
+        assert (moments.count, moments.min, moments.max) == (expected.count, expected.min, expected.max)
+        np.testing.assert_allclose([moments.mean, moments.variance], [expected.mean, expected.variance], rtol=1e-12)
+
+
+def test_diameter_bins_follow_pixel_spacing():
+    rng = np.random.default_rng(0)
+    pixels = FiberStatistics.for_pixel_spacing(1.0).update(random_segments(rng, 100))
+    rng = np.random.default_rng(0)
+    microns = FiberStatistics.for_pixel_spacing(0.05).update(random_segments(rng, 100, pixel_spacing=0.05))
+
+    np.testing.assert_array_equal(microns.diameter_histogram.counts, pixels.diameter_histogram.counts)
+    assert microns.diameter_histogram.overflow == pixels.diameter_histogram.overflow == 0
+
+
+def test_empty_statistics_to_json():
+    statistics = FiberStatistics.for_pixel_spacing(0.1, diameter_bin_width=0.02)
+    text = json.dumps({'summary': statistics.summary(), 'statistics': statistics.to_dict()}, allow_nan=False)
+    restored = FiberStatistics.from_dict(json.loads(text)['statistics'])
+
+    assert statistics.summary()['diameter_min'] is None
+    assert restored.diameter.min == np.inf and restored.diameter.max == -np.inf
+    assert restored.diameter_histogram.bin_width == 0.02
+    restored.merge(FiberStatistics.for_pixel_spacing(0.1, diameter_bin_width=0.02).update(np.array([0.3, 0.5])))
+    assert (restored.diameter.min, restored.diameter.max) == (0.3, 0.5)